@@ -1,39 +1,234 @@
+import base64
 import json
+from itertools import groupby
 
 from db import db
-from flask import Flask, request
+from flask import Flask, Response, request, send_from_directory, stream_with_context
 from db import Inventory
 from db import Category
 from db import Menu
 from db import Order
 from db import Orderitem
 from db import Asset
+from db import CatalogChange
+from db import inventory_category_association_table
+from db import inventory_order_menu_association_table
+from cache import ResponseCache, conditional
+import changes # logs catalog writes to catalog_change
+from config import configure_sqlite, engine_options, get_config, replica_binds
+from encoding import dumps, iter_list
+from events import EventBus, TooManySubscribers
+from images import UPLOAD_FORMATS, sniff_image
+from metrics import Metrics
+from migrations import upgrade
+from profiling import RequestProfiler
+from routing import ReplicaRouter
+from search import search_inventory_ids
+from storage import ImageTooLarge, LimitedReader, UploadQueue
+from sqlalchemy import and_, bindparam, delete, exists, func, insert, or_, select, update
+from sqlalchemy.orm import joinedload, selectinload, undefer_group
+from sqlalchemy.orm.attributes import set_committed_value
 
 import os
 import datetime
 
-# define db filename
-db_filename = "todo.db"
 app = Flask(__name__) #instiation of an instance of flask
 
-# setup config
-app.config["SQLALCHEMY_DATABASE_URI"] = f"sqlite:///{db_filename}" #specify the variations we are using
-app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = False  #has event listener feature to track the files modified
-app.config["SQLALCHEMY_ECHO"] = True  #what to know what our python code would translate to sql code
+# setup config, the profile is picked by APP_ENV (development or production)
+app.config.from_object(get_config())
+app.config["SQLALCHEMY_ENGINE_OPTIONS"] = engine_options(app.config)
+app.config["SQLALCHEMY_BINDS"] = replica_binds(app.config)
+if app.config["LOCAL_STORAGE_DIR"] is None:
+    app.config["LOCAL_STORAGE_DIR"] = os.path.join(app.instance_path, "uploads")
 
 # initialize app
 db.init_app(app)
 with app.app_context():
+    for engine in db.engines.values():
+        configure_sqlite(engine, app.config)
     db.create_all() # create all our tables
+    upgrade(db.engine) # bring existing databases up to the current schema
+    # gunicorn --preload forks the workers after this, they must not share
+    # the connections opened above
+    for engine in db.engines.values():
+        engine.dispose()
+
+# per endpoint latency and SQL metrics, served at /metrics
+metrics = Metrics(app)
+
+# profile single requests on demand, only installed with a PROFILE_TOKEN
+profiler = RequestProfiler(app)
+
+# send read-only requests to the replicas, if there are any
+replica_router = ReplicaRouter(app)
+
+response_cache = ResponseCache(app)
+# finished uploads change the status of menu images
+uploads = UploadQueue(app, on_complete=lambda: response_cache.invalidate("catalog"))
+metrics.add_collector("response_cache_lookups", "Response cache hits and misses", response_cache.stats)
+
+# order and catalog events pushed to GET /events/ subscribers
+events = EventBus(app)
+metrics.add_collector("event_subscribers", "Open event streams, events delivered and streams dropped", events.stats)
+
+
+def publish_order_event(event_type, order_id, data):
+    events.publish(["orders", f"order:{order_id}"], event_type, data)
+
+
+@changes.on_commit
+def publish_catalog_event(catalog_changes):
+    """
+    Tell subscribers which catalog rows a transaction changed, they
+    fetch the rows themselves from /catalog/changes/
+    """
+    data = {key: {"upserts": [], "deletes": []} for key in ["inventories", "categories", "menus"]}
+    keys = {"inventory": "inventories", "category": "categories", "menu": "menus"}
+    for (entity, entity_id), op in catalog_changes.items():
+        data[keys[entity]]["upserts" if op == "upsert" else "deletes"].append(entity_id)
+    events.publish(["catalog"], "catalog_changed", data)
 
 
 # generalized response formats
 def success_response(data, code=200):
-    return json.dumps(data), code
+    with metrics.serializing():
+        body = dumps(data)
+    return body, code
 
 
 def failure_response(message, code=404):
-    return json.dumps({"error": message}), code
+    return dumps({"error": message}), code
+
+
+# opt-in keyset pagination for list endpoints
+DEFAULT_PAGE_SIZE = 100
+MAX_PAGE_SIZE = 1000
+
+
+def is_paginated(always=False):
+    """
+    Whether the client asked for a page with ?limit= or ?after=,
+    always for endpoints that only return pages
+    """
+    return always or "limit" in request.args or "after" in request.args
+
+
+def encode_cursor(value, id):
+    return base64.urlsafe_b64encode(json.dumps([value, id]).encode()).decode()
+
+
+# ids past 64 bits can't be bound as SQL integers
+MAX_ID = 2 ** 63 - 1
+
+
+def is_id(value):
+    # bool is an int too, but true is no id
+    return isinstance(value, int) and not isinstance(value, bool) and abs(value) <= MAX_ID
+
+
+def decode_cursor(cursor, column):
+    """
+    The value of column and the id held by a cursor of a sorted page.
+    Raises ValueError unless both are of the right type
+    """
+    try:
+        value, id = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+    except (ValueError, TypeError):
+        raise ValueError("after is not a valid cursor")
+    if not is_id(id):
+        raise ValueError("after is not a valid cursor")
+    if column.type.python_type is float:
+        if not (is_id(value) or isinstance(value, float)):
+            raise ValueError("after is not a valid cursor")
+        value = float(value)
+    elif not isinstance(value, column.type.python_type):
+        raise ValueError("after is not a valid cursor")
+    return value, id
+
+
+def paginate(query, model, sort=None, always=False):
+    """
+    Return one page of query ordered by the primary key of model,
+    starting after the ?after= cursor and holding at most ?limit= rows,
+    together with the cursor of the next page (None on the last page).
+    Pages are read with an indexed range scan on the primary key instead
+    of OFFSET. Without ?limit= or ?after= every row is returned, unless
+    always is set.
+    sort, a (column, descending) pair, orders the rows by column first;
+    its cursors are opaque strings holding the column value and the
+    primary key of the last row, and pages are read from an index on
+    (column, id).
+    Raises ValueError on malformed pagination arguments
+    """
+    if sort is not None:
+        column, descending = sort
+        order_by = [column.desc() if descending else column, model.id]
+    else:
+        order_by = [model.id]
+
+    if not is_paginated(always):
+        if sort is not None:
+            query = query.order_by(*order_by)
+        return query.all(), None
+
+    try:
+        limit = int(request.args.get("limit", DEFAULT_PAGE_SIZE))
+    except ValueError:
+        raise ValueError("limit must be an integer")
+    if limit < 1 or limit > MAX_PAGE_SIZE:
+        raise ValueError(f"limit must be between 1 and {MAX_PAGE_SIZE}")
+
+    after = request.args.get("after")
+    if sort is None:
+        try:
+            after_id = int(after or 0)
+        except ValueError:
+            raise ValueError("after must be an integer")
+        if not is_id(after_id):
+            raise ValueError("after is out of range")
+        query = query.filter(model.id > after_id)
+    elif after is not None:
+        value, after_id = decode_cursor(after, column)
+        past = column < value if descending else column > value
+        query = query.filter(or_(past, and_(column == value, model.id > after_id)))
+
+    # fetch one extra row to know whether there is a next page
+    rows = query.order_by(*order_by).limit(limit + 1).all()
+    if len(rows) <= limit:
+        return rows, None
+    last = rows[limit - 1]
+    if sort is None:
+        return rows[:limit], last.id
+    return rows[:limit], encode_cursor(getattr(last, column.key), last.id)
+
+
+def list_response(key, items, next_cursor, always=False):
+    """
+    Response for a list endpoint, with the next cursor when paginated
+    """
+    data = {key: items}
+    if is_paginated(always):
+        data["next_cursor"] = next_cursor
+    return success_response(data)
+
+
+# rows read from the database at a time by streamed list responses
+STREAM_BATCH_SIZE = 500
+
+
+def stream_list_response(key, rows, serialize):
+    """
+    Response for a whole list endpoint, {key: [serialize(row), ...]}
+    encoded row by row while rows is iterated, so neither every row nor
+    the whole body is held in memory. rows should read the database
+    STREAM_BATCH_SIZE rows at a time, as query.yield_per does
+    """
+    def encode(row):
+        data = serialize(row)
+        with metrics.serializing():
+            return dumps(data)
+
+    return Response(stream_with_context(iter_list(key, rows, encode)))
 
 
 # -- TASK ROUTES ------------------------------------------------------
@@ -43,16 +238,122 @@ def greet_user():
     return "Hello" + os.environ.get("NAME")
 
 
+# orders of GET /inventories/?sort=, as (column, descending)
+INVENTORY_SORTS = {
+    "id": (Inventory.id, False),
+    "price": (Inventory.price, False),
+    "-price": (Inventory.price, True),
+    "name": (Inventory.name, False),
+    "-name": (Inventory.name, True)
+}
+INVENTORY_FILTERS = ("category", "menu", "min_price", "max_price", "sort")
+
+
+def filter_inventories(query):
+    """
+    Apply the ?category=, ?menu=, ?min_price= and ?max_price= filters
+    of GET /inventories/ to query. Categories and menus are matched in
+    SQL through their association table indexes.
+    Raises ValueError on malformed filters
+    """
+    args = request.args
+    try:
+        category_id = int(args["category"]) if "category" in args else None
+        menu_id = int(args["menu"]) if "menu" in args else None
+    except ValueError:
+        raise ValueError("category and menu must be integers")
+    if not all(is_id(i) for i in (category_id, menu_id) if i is not None):
+        raise ValueError("category and menu are out of range")
+    if category_id is not None:
+        query = query.filter(Inventory.id.in_(
+            select(inventory_category_association_table.c.inventory_id)
+            .where(inventory_category_association_table.c.category_id == category_id)
+        ))
+    if menu_id is not None:
+        query = query.filter(Inventory.id.in_(
+            select(inventory_order_menu_association_table.c.inventory_id)
+            .where(inventory_order_menu_association_table.c.menu_id == menu_id)
+        ))
+    try:
+        if "min_price" in args:
+            query = query.filter(Inventory.price >= float(args["min_price"]))
+        if "max_price" in args:
+            query = query.filter(Inventory.price <= float(args["max_price"]))
+    except ValueError:
+        raise ValueError("min_price and max_price must be numbers")
+    return query
+
+
+def inventory_query():
+    """
+    Query for inventories with what serialize_for_render shows of their
+    orderitems and categories loaded in the same SELECT, so a list of
+    any size is one statement
+    """
+    return Inventory.query.options(undefer_group("render"))
+
+
 @app.route("/inventories/")
+@conditional
+@response_cache.cached("catalog", "orders")
 def get_inventories():
     """
     Endpoint for getting all inventories
+    Filtered or sorted requests (?category=, ?menu=, ?min_price=,
+    ?max_price=, ?sort=) always return pages of ?limit= rows
     """
+    sort = request.args.get("sort", "id")
+    if sort not in INVENTORY_SORTS:
+        return failure_response(f"sort must be one of {', '.join(INVENTORY_SORTS)}", 400)
+    filtered = any(arg in request.args for arg in INVENTORY_FILTERS)
+
+    query = inventory_query()
+    try:
+        query = filter_inventories(query)
+        sort_column = None if sort == "id" else INVENTORY_SORTS[sort]
+        rows, next_cursor = paginate(query, Inventory, sort=sort_column, always=filtered)
+    except ValueError as e:
+        return failure_response(f"{e}", 400)
+
     inventories = []
-    for inventory in Inventory.query.all():  
+    for inventory in rows:  
         inventories.append(inventory.serialize_for_render()) 
 
-    return success_response({"inventories": inventories})
+    return list_response("inventories", inventories, next_cursor, always=filtered)
+
+
+# most results a search returns
+DEFAULT_SEARCH_LIMIT = 20
+MAX_SEARCH_LIMIT = 100
+
+
+@app.route("/inventories/search/")
+@conditional
+@response_cache.cached("catalog", "orders")
+def search_inventories():
+    """
+    Endpoint for searching inventories by name, description and category
+    names with ?q=, best matches first, at most ?limit= of them
+    """
+    q = request.args.get("q", "")
+    try:
+        limit = int(request.args.get("limit", DEFAULT_SEARCH_LIMIT))
+    except ValueError:
+        return failure_response("limit must be an integer", 400)
+    if limit < 1 or limit > MAX_SEARCH_LIMIT:
+        return failure_response(f"limit must be between 1 and {MAX_SEARCH_LIMIT}", 400)
+    if not q.strip():
+        return failure_response("Missing search query q", 400)
+
+    ids = search_inventory_ids(db.session, q, limit)
+    inventories = {}
+    if ids:
+        for inventory in inventory_query().filter(Inventory.id.in_(ids)):
+            inventories[inventory.id] = inventory
+
+    return success_response({
+        "inventories": [inventories[i].serialize_for_render() for i in ids if i in inventories]
+    })
 
 
 @app.route("/test/inventories/")
@@ -60,14 +361,18 @@ def test_get_inventories():
     """
     Endpoint for getting all inventories
     """
-    inventories = []
-    for inventory in Inventory.query.all():  
-        inventories.append(inventory.serialize_all()) 
-
-    return success_response({"inventories": inventories})
+    query = Inventory.query.options(
+        selectinload(Inventory.categories),
+        selectinload(Inventory.menus),
+        selectinload(Inventory.order_items)
+    )
+    return stream_list_response(
+        "inventories", query.order_by(Inventory.id).yield_per(STREAM_BATCH_SIZE), Inventory.serialize_all
+    )
 
 
 @app.route("/inventories/", methods=["POST"])
+@response_cache.invalidates("catalog")
 def create_inventory():
     """
     Endpoint for creating a new task
@@ -90,7 +395,7 @@ def get_inventory_by_id(inventory_id):
     """
     Endpoint for getting an inventory by id
     """
-    inventory = Inventory.query.filter_by(id = inventory_id).first()
+    inventory = inventory_query().filter_by(id = inventory_id).first()
     if inventory is None:
         return failure_response(f"Task not found {inventory_id}!")
     return success_response(inventory.serialize_for_render())
@@ -98,7 +403,16 @@ def get_inventory_by_id(inventory_id):
 
 # -- CATEGORY ROUTES---------------------------------------------------
 
+def category_query():
+    """
+    Query for categories with their inventories loaded in bulk
+    so that Category.serialize does not hit the database per category
+    """
+    return Category.query.options(selectinload(Category.inventories))
+
+
 @app.route("/inventories/<int:inventory_id>/category/", methods=["POST"])
+@response_cache.invalidates("catalog")
 def assign_category(inventory_id):
     """
     Endpoint for assigning a category
@@ -121,22 +435,31 @@ def assign_category(inventory_id):
 
 
 @app.route("/categories/", methods=["GET"])
+@conditional
+@response_cache.cached("catalog")
 def get_all_categories():
     """
     Endpoint for getting all inventories
     """
+    try:
+        rows, next_cursor = paginate(category_query(), Category)
+    except ValueError as e:
+        return failure_response(f"{e}", 400)
+
     categories = []
-    for category in Category.query.all(): 
+    for category in rows: 
         categories.append(category.serialize()) 
-    return success_response({"categories": categories})
+    return list_response("categories", categories, next_cursor)
 
 
 @app.route("/categories/<int:category_id>/", methods=["GET"])
+@conditional
+@response_cache.cached("catalog")
 def get_category(category_id):
     """
     Endpoint for getting a category by id
     """
-    category = Category.query.filter_by(id = category_id).first()
+    category = category_query().filter_by(id = category_id).first()
     if category is None:
         return failure_response("Category not found!")
     return success_response(category.serialize())
@@ -145,50 +468,101 @@ def get_category(category_id):
 @app.route("/categories/m/", methods=["GET"])
 def get_categories():
     """
-    Endpoint for getting multiple categories by ids
+    Endpoint for getting multiple categories by ids, either as
+    ?ids=1,2,3 or with the positional ?c0=1&c1=2 arguments.
+    With ids= unknown ids are listed under "missing" instead of
+    failing the whole batch
     """
-    length :int = len(request.args)
-    print(length)
-    category_id_list =[]
-    for i in range(length):
-        category_id_list.append(request.args[f"c{i}"])
+    ids = request.args.get("ids")
+    try:
+        if ids is not None:
+            category_id_list = [int(i) for i in ids.split(",") if i.strip()]
+        else:
+            length :int = len(request.args)
+            category_id_list = [int(request.args[f"c{i}"]) for i in range(length)]
+    except (KeyError, ValueError):
+        return failure_response("Category ids must be integers", 400)
+    if not all(is_id(i) for i in category_id_list):
+        return failure_response("Category ids are out of range", 400)
+
+    # one IN query for the categories and one for all of their inventories
+    categories = {}
+    if category_id_list:
+        for category in category_query().filter(Category.id.in_(set(category_id_list))):
+            categories[category.id] = category
 
     response = []
+    missing = []
     for category_id in category_id_list:
-      category = Category.query.filter_by(id = category_id).first()
+      category = categories.get(category_id)
       if category is None:
-        return failure_response("Category not found!")
+        missing.append(category_id)
+        continue
       response.append(category.serialize())
-      
-    return success_response({"categories": response })
+
+    if ids is None:
+      if missing:
+        return failure_response("Category not found!")
+      return success_response({"categories": response })
+    return success_response({"categories": response, "missing": missing})
 
 # -- MENU ROUTES---------------------------------------------------
 
+def menu_query():
+    """
+    Query for menus with their image and inventories loaded in bulk
+    so that Menu.serialize does not hit the database per menu
+    """
+    return Menu.query.options(
+        joinedload(Menu.image).selectinload(Asset.variants),
+        selectinload(Menu.inventories)
+    )
+
+
 @app.route("/menus/", methods=["GET"])
+@conditional
+@response_cache.cached("catalog")
 def get_menus():
     """
     Endpoint for getting all menus
     """
+    try:
+        rows, next_cursor = paginate(menu_query(), Menu)
+    except ValueError as e:
+        return failure_response(f"{e}", 400)
+
     menus = []
-    for menu in Menu.query.all(): 
+    for menu in rows: 
         menus.append(menu.serialize()) 
-    return success_response({"menus": menus})
+    return list_response("menus", menus, next_cursor)
 
 
 @app.route("/menus/", methods=["POST"])
+@response_cache.invalidates("catalog")
 def create_menu():
     """
     Endpoint for creating a new menu
     """
     body = json.loads(request.data)  
 
+    # either an image uploaded through POST /assets/ or a base64 data URL
+    image_id = body.get("image_id")
     image_data = body.get("image_data")
-    if image_data is None:
+    pending_upload = None
+    if image_id is not None:
+        image = Asset.query.filter_by(id = image_id).first()
+        if image is None:
+            return failure_response("Image not found!")
+    elif image_data is None:
         return failure_response("Not Base64 URL")
-    
-    image = Asset(image_data=image_data)
-    db.session.add(image)
-    db.session.commit()
+    else:
+        try:
+            image = Asset(image_data=image_data, base_url=uploads.base_url)
+        except ValueError as e:
+            return failure_response(f"{e}", 400)
+        db.session.add(image)
+        db.session.flush()
+        pending_upload = (image.id, image.filename, image.data, image.content_type)
     
     new_menu= Menu(
         name = body.get("name"),
@@ -199,6 +573,14 @@ def create_menu():
 
     db.session.add(new_menu)
     db.session.commit()
+
+    # the image is uploaded in the background, the asset is pending until then.
+    # its attributes were read before the commit, so that an inline upload
+    # does not wait on a transaction this session opened to reload them
+    if pending_upload is not None:
+        uploads.enqueue(*pending_upload)
+
+    new_menu = menu_query().filter_by(id = new_menu.id).first()
     return success_response(new_menu.serialize(), 201)
 
 
@@ -207,36 +589,92 @@ def get_menu_by_id(menu_id):
     """
     Endpoint for getting a menu by id
     """
-    menu = Menu.query.filter_by(id = menu_id).first()
+    menu = menu_query().filter_by(id = menu_id).first()
     if menu is None:
         return failure_response(f"Menu not found {menu_id}!")
     return success_response(menu.serialize())
 
 
 @app.route("/menus/<int:menu_id>/", methods=["DELETE"])
+@response_cache.invalidates("catalog")
 def delete_menu(menu_id):
     """
     Endpoint for delting a menu
     """
-    menu = Menu.query.filter_by(id = menu_id).first()
+    menu = menu_query().filter_by(id = menu_id).first()
     if menu is None:
         return failure_response("menu not found!")
+    # serialize before deleting, the row is gone after the commit
+    serialized_menu = menu.serialize()
     db.session.delete(menu)
     db.session.commit()
-    return success_response(menu.serialize())
+    return success_response(serialized_menu)
 
 
 # -- ORDER ROUTES---------------------------------------------------
 
+def order_query():
+    """
+    Query for orders with their orderitems and the referenced inventories
+    loaded in bulk, each inventory is fetched once through the session's
+    identity map no matter how many orderitems point at it
+    """
+    return Order.query.options(
+        selectinload(Order.order_items).selectinload(Orderitem.inventory)
+    )
+
+
+def stream_orders():
+    """
+    Every order with its orderitems and their inventories, read in two
+    statements whatever the number of orders: one for the orders and one
+    for the orderitems joined to their inventory, both sorted by order id
+    and read STREAM_BATCH_SIZE rows at a time, then merged like a join.
+    Eager loading per batch instead would run two more statements for
+    every STREAM_BATCH_SIZE orders
+    """
+    orders = db.session.execute(
+        select(Order).order_by(Order.id).execution_options(yield_per = STREAM_BATCH_SIZE)
+    ).scalars()
+    # lines in the order they were added, like Order.order_items;
+    # (order_id, id) is the order of an index, no sort needed
+    order_items = db.session.execute(
+        select(Orderitem).options(joinedload(Orderitem.inventory))
+        .order_by(Orderitem.order_id, Orderitem.id)
+        .execution_options(yield_per = STREAM_BATCH_SIZE)
+    ).scalars()
+
+    groups = groupby(order_items, key = lambda orderitem: orderitem.order_id)
+    group = next(groups, None)
+    for order in orders:
+        # orderitems of an order deleted since are skipped
+        while group is not None and group[0] < order.id:
+            group = next(groups, None)
+        items = []
+        if group is not None and group[0] == order.id:
+            items = list(group[1])
+            group = next(groups, None)
+        # loaded state, not a change to flush
+        set_committed_value(order, "order_items", items)
+        yield order
+
+
 @app.route("/orders/", methods=["GET"])
 def get_orders():
     """
     Endpoint for getting all orders
     """
+    if not is_paginated():
+        return stream_list_response("orders", stream_orders(), Order.simple_serialize)
+    try:
+        rows, next_cursor = paginate(order_query(), Order)
+    except ValueError as e:
+        return failure_response(f"{e}", 400)
+
     orders = []
-    for order in Order.query.all(): 
+    for order in rows: 
         orders.append(order.simple_serialize()) 
-    return success_response({"orders": orders})
+    return list_response("orders", orders, next_cursor)
 
 # @app.route("/orders/", methods=["POST"])
 # def create_order():
@@ -269,63 +707,124 @@ def get_orders():
 #     return success_response(new_order.serialize(), 201)
 
 
-@app.route("/orders/", methods=["POST"])
-def create_order():
+def compute_pick_up_by(time_created):
     """
-    Endpoint for creating a new order
+    Return the pick up deadline of an order created at time_created
     """
-    body = json.loads(request.data)  
-    new_order= Order(
-        total_price = body.get("total_price", 0),     
-        valid = body.get("total_price", False)
-    )
+    # if the order is created after 19 
+    if time_created.hour > 19:
+      pick_up_time = time_created + datetime.timedelta(days = 1)
+      pick_up_time = pick_up_time.replace(hour =  18, minute= 59, second= 59)
+    else:
+      pick_up_time = time_created + datetime.timedelta(hours = 2)
+      if  pick_up_time.hour > 19:
+        pick_up_time = pick_up_time.replace(hour =  18, minute= 59, second= 59)
+    return pick_up_time
 
-    new_order = Order()
 
-    db.session.add(new_order)
-    db.session.commit()
+# most units of one inventory a cart can hold
+MAX_NUM_SEL = 1000
 
-    #inventory.type = json
-    inventory_list = body.get("inventories")
 
-    try:
-      for inventory in inventory_list:
-        simlpe_create_orderitem(new_order.id, inventory) 
-    except Exception as e:
-        return failure_response(f"{e}")
+def parse_cart(inventory_list, allow_zero=False):
+    """
+    Validate cart lines of the form {"inventory_id": 1, "num_sel": 2}
+    Return a dict of num_sel by inventory_id in cart order, lines for the
+    same inventory are merged. With allow_zero lines may have num_sel 0,
+    they are left out of the result. No inventory may add up to more
+    than MAX_NUM_SEL
+    Raises ValueError on a malformed line
+    """
+    if not isinstance(inventory_list, list):
+        raise ValueError("inventories must be a list")
+
+    cart = {}
+    for line in inventory_list:
+        if not isinstance(line, dict):
+            raise ValueError("Each inventory must be an object")
+        inventory_id = line.get("inventory_id")
+        num_sel = line.get("num_sel")
+        if not is_id(inventory_id) or type(num_sel) is not int or num_sel < (0 if allow_zero else 1):
+            raise ValueError(f"Invalid inventory line: {line}")
+        if num_sel > 0:
+            cart[inventory_id] = cart.get(inventory_id, 0) + num_sel
+            if cart[inventory_id] > MAX_NUM_SEL:
+                raise ValueError(f"num_sel of inventory {inventory_id} is more than {MAX_NUM_SEL}")
+    return cart
+
+
+def load_cart_inventories(cart):
+    """
+    Load every inventory referenced by cart with one IN query
+    Return a dict of inventories by id and the list of unknown ids
+    """
+    inventories = {}
+    if cart:
+        for inventory in Inventory.query.filter(Inventory.id.in_(cart.keys())):
+            inventories[inventory.id] = inventory
+    missing = [i for i in cart if i not in inventories]
+    return inventories, missing
 
-    db.session.commit()
 
-    new_order.time_created = datetime.datetime.now()
-    # if the order is created after 19 
-    if new_order.time_created.hour > 19:
-      pick_up_time = new_order.time_created + datetime.timedelta(days = 1)
-      pick_up_time = pick_up_time.replace(hour =  18, minute= 59, second= 59)
-    else:
-      pick_up_time = new_order.time_created + datetime.timedelta(hours = 2)
-      if  pick_up_time.hour > 19:
-        pick_up_time = pick_up_time.replace(hour =  18, minute= 59, second= 59)
+@app.route("/orders/", methods=["POST"])
+@response_cache.invalidates("orders")
+def create_order():
+    """
+    Endpoint for creating a new order
+    All cart lines are validated first, then the order and its orderitems
+    are inserted in a single transaction, so a bad line leaves nothing behind
+    """
+    body = json.loads(request.data)  
 
-    new_order.pick_up_by = pick_up_time 
-    new_order.valid = True
+    #inventory.type = json
+    try:
+        cart = parse_cart(body.get("inventories"))
+    except ValueError as e:
+        return failure_response(f"{e}", 400)
+
+    inventories, missing = load_cart_inventories(cart)
+    if missing:
+        return failure_response(f"Inventory not found! {missing}")
+
+    time_created = datetime.datetime.now()
+    new_order = Order(
+        total_price = sum(inventories[i].price * num_sel for i, num_sel in cart.items()),
+        valid = True
+    )
+    new_order.time_created = time_created
+    new_order.pick_up_by = compute_pick_up_by(time_created)
 
+    db.session.add(new_order)
+    db.session.flush()
+
+    # one batched INSERT for every orderitem
+    if cart:
+        db.session.execute(insert(Orderitem), [
+            {"order_id": new_order.id, "inventory_id": i, "num_sel": num_sel}
+            for i, num_sel in cart.items()
+        ])
     db.session.commit()
 
-    return success_response(new_order.simple_serialize(), 201)
+    new_order = order_query().filter_by(id = new_order.id).first()
+    data = new_order.simple_serialize()
+    publish_order_event("order_created", new_order.id, data)
+    return success_response(data, 201)
 
 
 @app.route("/orders/<int:order_id>/", methods=["GET"])
+@conditional
 def get_order_by_id(order_id):
     """
     Endpoint for getting an order by id
     """
-    order = Order.query.filter_by(id = order_id).first()
-    if order_id is None:
+    order = order_query().filter_by(id = order_id).first()
+    if order is None:
         return failure_response(f"Task not found {order_id}!")
     return success_response(order.simple_serialize())
 
 
 @app.route("/orders/<int:order_id>/", methods=["POST"])
+@response_cache.invalidates("orders")
 def add_orderitem_to_order(order_id):
     """
    Endpoint for adding one orderitem to an existing order
@@ -345,11 +844,77 @@ def add_orderitem_to_order(order_id):
       
     except Exception as e:
         return failure_response(f"{e}")
-        
-    return success_response(orderitem.serialize())
+
+    data = orderitem.serialize()
+    publish_order_event("order_updated", order_id, {"order_id": order_id, **data})
+    return success_response(data)
+
+
+@app.route("/orders/<int:order_id>/items", methods=["PUT"])
+@response_cache.invalidates("orders")
+def sync_order_items(order_id):
+    """
+    Endpoint for replacing the whole cart of an order
+    The body lists every wanted inventory like POST /orders/ does, lines
+    missing from it (or with num_sel 0) are removed. Inserts, updates,
+    deletes and the new total price are applied in one transaction, with
+    the order row locked so that cart writers of one order run one at a time
+    """
+    body = json.loads(request.data)
+    try:
+        cart = parse_cart(body.get("inventories"), allow_zero = True)
+    except ValueError as e:
+        return failure_response(f"{e}", 400)
+
+    inventories, missing = load_cart_inventories(cart)
+    if missing:
+        return failure_response(f"Inventory not found! {missing}")
+
+    order = Order.query.filter_by(id = order_id).with_for_update().first()
+    if order is None:
+        db.session.rollback()
+        return failure_response("Order not found!")
+
+    existing = {}
+    for orderitem in Orderitem.query.filter_by(order_id = order_id):
+        existing[orderitem.inventory_id] = orderitem
+
+    inserts = []
+    updates = []
+    for inventory_id, num_sel in cart.items():
+        orderitem = existing.get(inventory_id)
+        if orderitem is None:
+            inserts.append({"order_id": order_id, "inventory_id": inventory_id, "num_sel": num_sel})
+        elif orderitem.num_sel != num_sel:
+            updates.append({"orderitem_id": orderitem.id, "new_num_sel": num_sel})
+    deletes = [oi.id for inventory_id, oi in existing.items() if inventory_id not in cart]
+
+    if inserts:
+        db.session.execute(insert(Orderitem), inserts)
+    if updates:
+        db.session.execute(
+            update(Orderitem.__table__)
+            .where(Orderitem.id == bindparam("orderitem_id"))
+            .values(num_sel = bindparam("new_num_sel")),
+            updates
+        )
+    if deletes:
+        db.session.execute(
+            delete(Orderitem)
+            .where(Orderitem.id.in_(deletes))
+            .execution_options(synchronize_session = False)
+        )
+    order.total_price = sum(inventories[i].price * num_sel for i, num_sel in cart.items())
+    db.session.commit()
+
+    order = order_query().filter_by(id = order_id).first()
+    data = order.simple_serialize()
+    publish_order_event("order_updated", order_id, data)
+    return success_response(data)
 
 
 @app.route("/orders/submit/<int:order_id>/", methods=["POST"])
+@response_cache.invalidates("orders")
 def submit_order(order_id):
     """
     Endpoint for submitting all orderitems with pickup information 
@@ -361,24 +926,18 @@ def submit_order(order_id):
     body = json.loads(request.data)  
     order.user_name =  body.get("user_name")
     order.time_created = datetime.datetime.now()
-    # if the order is created after 19 
-    if order.time_created.hour > 19:
-      pick_up_time = order.time_created + datetime.timedelta(days = 1)
-      pick_up_time = pick_up_time.replace(hour =  18, minute= 59, second= 59)
-    else:
-      pick_up_time = order.time_created + datetime.timedelta(hours = 2)
-      if  pick_up_time.hour > 19:
-        pick_up_time = pick_up_time.replace(hour =  18, minute= 59, second= 59)
-
-    order.pick_up_by = pick_up_time 
+    order.pick_up_by = compute_pick_up_by(order.time_created)
     order.valid = True
 
     db.session.commit()
 
-    return success_response(order.serialize())
+    data = order.serialize()
+    publish_order_event("order_submitted", order_id, data)
+    return success_response(data)
 
 
 @app.route("/orders/<int:order_id>/", methods=["DELETE"])
+@response_cache.invalidates("orders")
 def delete_order(order_id):
     """
     Endpoint for delting an order
@@ -388,6 +947,7 @@ def delete_order(order_id):
         return failure_response("Order not found!")
     db.session.delete(order)
     db.session.commit()
+    publish_order_event("order_deleted", order_id, {"id": order_id})
     return success_response(order.serialize())
 
 
@@ -398,20 +958,20 @@ def get_orderitems():
     """
     Endpoint for getting all orderitems
     """
+    if not is_paginated():
+        return stream_list_response(
+            "orderitems", Orderitem.query.order_by(Orderitem.id).yield_per(STREAM_BATCH_SIZE), Orderitem.serialize
+        )
+    try:
+        rows, next_cursor = paginate(Orderitem.query, Orderitem)
+    except ValueError as e:
+        return failure_response(f"{e}", 400)
+
     orderitems = []
-    for orderitem in Orderitem.query.all(): 
+    for orderitem in rows: 
         orderitems.append(orderitem.serialize()) 
-    return success_response({"orderitems": orderitems})
-
-
-def simlpe_create_orderitem(order_id, inventory_json):
-    """
-    Return the total price to the orderitem
-    """
-    inventory_id = inventory_json.get("inventory_id")
-    num_sel =  inventory_json.get("num_sel")
+    return list_response("orderitems", orderitems, next_cursor)
 
-    orderitem = create_orderitem(inventory_id, num_sel, order_id)
 
 def create_orderitem(inventory_id, num_sel, order_id):
     """
@@ -442,12 +1002,11 @@ def create_orderitem(inventory_id, num_sel, order_id):
     db.session.add(orderitem)
     db.session.commit()
 
-    print("orderitem type in create order item", type(orderitem))
-
     return orderitem
 
 
 @app.route("/orderitems/<int:order_id>/<int:inventory_id>/increase/", methods=["POST"])
+@response_cache.invalidates("orders")
 def increase_orderitem(order_id, inventory_id):
   """
   Endpoint for increasing the number of an inventory in an order by 1
@@ -456,6 +1015,7 @@ def increase_orderitem(order_id, inventory_id):
 
 
 @app.route("/orderitems/<int:order_id>/<int:inventory_id>/decrease/", methods=["POST"])
+@response_cache.invalidates("orders")
 def decrease_orderitem(order_id, inventory_id):
   """
   Endpoint for decreasing the number of an inventory in an order by 1
@@ -465,34 +1025,77 @@ def decrease_orderitem(order_id, inventory_id):
 
 def update_orderitem(order_id, inventory_id, num_sel_diff):
     """
-    Update the  the number of an inventory in an order by num_sel_diff
+    Update the number of an inventory in an order by num_sel_diff
+    The number and the order total are changed by UPDATE statements relative
+    to the stored values, in one transaction, so concurrent taps can't lose
+    updates. The orderitem is deleted when its number reaches 0, and the
+    order when it has no orderitems left.
+    Returns only what changed instead of the whole order
     """
-    order = Order.query.filter_by(id = order_id).first()
-    if order is None:
-        return failure_response("Order not found!")
-    
-    inventory = Inventory.query.filter_by(id = inventory_id).first()
-    if inventory is None:
-        return failure_response("Inventory not found!")
-
-    orderitem = Orderitem.query.filter_by(order_id = order_id, inventory_id = inventory_id ).first()
-    if orderitem is None:
-        return failure_response("Order not found!")
-
-    orderitem.num_sel += num_sel_diff
-    price_diff = num_sel_diff * inventory.price
-    order.total_price += price_diff
-    db.session.commit()
-
-    if orderitem.num_sel == 0:
-      delete_orderitem(order_id, inventory_id)
+    orderitem_filter = (Orderitem.order_id == order_id, Orderitem.inventory_id == inventory_id)
+    updatable = (*orderitem_filter, Orderitem.num_sel + num_sel_diff >= 0)
+
+    # the order row is updated (and locked) first, like PUT /orders/<id>/items
+    # locks it first, so the two can't wait on each other's rows
+    price = select(Inventory.price).where(Inventory.id == inventory_id).scalar_subquery()
+    result = db.session.execute(
+        update(Order)
+        .where(Order.id == order_id, exists().where(*updatable))
+        .values(total_price = Order.total_price + num_sel_diff * func.coalesce(price, 0))
+        .execution_options(synchronize_session = False)
+    )
+    if result.rowcount == 1:
+        result = db.session.execute(
+            update(Orderitem)
+            .where(*updatable)
+            .values(num_sel = Orderitem.num_sel + num_sel_diff)
+            .execution_options(synchronize_session = False)
+        )
+    if result.rowcount == 0:
+        db.session.rollback()
+        return failure_response("Order item not found!")
+
+    num_sel, total_price = db.session.execute(
+        select(Orderitem.num_sel, Order.total_price)
+        .join(Order, Order.id == Orderitem.order_id)
+        .where(*orderitem_filter)
+    ).one()
+
+    deleted = False
+    order_deleted = False
+    if num_sel == 0:
+        db.session.execute(
+            delete(Orderitem)
+            .where(*orderitem_filter, Orderitem.num_sel == 0)
+            .execution_options(synchronize_session = False)
+        )
+        deleted = True
+        # the order goes away with its last orderitem
+        result = db.session.execute(
+            delete(Order).where(
+                Order.id == order_id,
+                ~exists().where(Orderitem.order_id == order_id)
+            )
+            .execution_options(synchronize_session = False)
+        )
+        order_deleted = result.rowcount > 0
 
     db.session.commit()
 
-    return success_response(order.serialize())
+    data = {
+        "order_id": order_id,
+        "inventory_id": inventory_id,
+        "num_sel": num_sel,
+        "total_price": total_price,
+        "deleted": deleted,
+        "order_deleted": order_deleted
+    }
+    publish_order_event("order_deleted" if order_deleted else "order_updated", order_id, data)
+    return success_response(data)
 
     
 @app.route("/orderitems/<int:order_id>/<int:inventory_id>/", methods=["DELETE"])
+@response_cache.invalidates("orders")
 def delete_orderitem(order_id, inventory_id):
     """
     Endpoint for deletinf an orderitem
@@ -511,6 +1114,7 @@ def delete_orderitem(order_id, inventory_id):
 
     db.session.delete(orderitem)
     db.session.commit()
+    publish_order_event("order_updated", order_id, {"order_id": order_id, "inventory_id": inventory_id, "deleted": True})
     #check if the order_items of order is empty: if empty delte the order
     if len(order.order_items) == 0:
         delete_order(order_id)
@@ -518,7 +1122,207 @@ def delete_orderitem(order_id, inventory_id):
     return success_response(order.serialize())
 
 
+# -- ASSET ROUTES---------------------------------------------------
+
+@app.route("/assets/", methods=["POST"])
+def upload_asset():
+    """
+    Endpoint for uploading an image, sent either as the raw request body
+    (Content-Type: image/png, image/jpeg or image/gif) or as the "image"
+    field of a multipart form. The body is streamed into storage in chunks
+    while its type and size are read from the header bytes, so the image
+    is never held in memory as a whole. Returns the new asset, whose id
+    can be passed as image_id to POST /menus/
+    """
+    max_size = app.config["MAX_IMAGE_SIZE"]
+    if request.content_length is not None and request.content_length > max_size:
+        return failure_response(f"Image is larger than {max_size} bytes", 413)
+
+    if request.mimetype == "multipart/form-data":
+        # werkzeug spools form files to disk, only parse bounded bodies
+        if request.content_length is None:
+            return failure_response("Content-Length required", 411)
+        upload = request.files.get("image")
+        if upload is None:
+            return failure_response("Missing image field", 400)
+        stream = upload.stream
+    else:
+        stream = request.stream
+
+    try:
+        image_format, width, height, header = sniff_image(stream)
+    except ValueError as e:
+        return failure_response(f"{e}", 400)
+    if image_format not in UPLOAD_FORMATS:
+        return failure_response(f"Unsupported file type: {image_format}", 400)
+    extension, content_type = UPLOAD_FORMATS[image_format]
+
+    image = Asset(base_url=uploads.base_url, extension=extension, width=width, height=height)
+    db.session.add(image)
+    db.session.flush()
+    # read before the commit: reloading the expired asset afterwards would
+    # open a transaction, which write requests start by taking the SQLite
+    # write lock, and hold it for the whole upload
+    data = {"id": image.id, **image.serialize()}
+    filename = image.filename
+    db.session.commit()
+
+    try:
+        uploads.storage.put(filename, LimitedReader(header, stream, max_size), content_type)
+    except Exception as e:
+        db.session.execute(delete(Asset).where(Asset.id == data["id"]))
+        db.session.commit()
+        if isinstance(e, ImageTooLarge):
+            return failure_response(f"{e}", 413)
+        return failure_response(f"Error when uploading image: {e}", 502)
+
+    db.session.execute(update(Asset).where(Asset.id == data["id"]).values(status = "ready"))
+    db.session.commit()
+    data["status"] = "ready"
+    uploads.enqueue_variants(data["id"], filename)
+
+    return success_response(data, 201)
+
+
+@app.route("/uploads/<path:filename>")
+def get_upload(filename):
+    """
+    Endpoint for serving images when they are stored locally
+    """
+    if app.config["STORAGE_BACKEND"] != "local":
+        return failure_response("Not found!")
+    return send_from_directory(app.config["LOCAL_STORAGE_DIR"], filename)
+
+
+# -- CATALOG SYNC ROUTES---------------------------------------------------
+
+def catalog_entities(entity, ids):
+    """
+    Serialize the inventories, categories or menus with the given ids,
+    as their list endpoints do. Returns a dict by id
+    """
+    if entity == "inventory":
+        return {i.id: i.serialize_for_render() for i in inventory_query().filter(Inventory.id.in_(ids))}
+    if entity == "category":
+        return {c.id: c.serialize() for c in category_query().filter(Category.id.in_(ids))}
+    return {m.id: m.serialize() for m in menu_query().filter(Menu.id.in_(ids))}
+
+
+@app.route("/catalog/changes/", methods=["GET"])
+@conditional
+@response_cache.cached("catalog", "orders")
+def get_catalog_changes():
+    """
+    Endpoint for the inventories, categories and menus changed after the
+    ?since= token (0 for everything), at most ?limit= changes at a time.
+    Changed rows are returned whole under "upserts" and deleted ones as
+    ids under "deletes". Pass "next" as since to get the following
+    changes, "has_more" tells whether there are any yet
+    """
+    try:
+        since = int(request.args.get("since", 0))
+        limit = int(request.args.get("limit", DEFAULT_PAGE_SIZE))
+    except ValueError:
+        return failure_response("since and limit must be integers", 400)
+    if not is_id(since):
+        return failure_response("since is out of range", 400)
+    if limit < 1 or limit > MAX_PAGE_SIZE:
+        return failure_response(f"limit must be between 1 and {MAX_PAGE_SIZE}", 400)
+
+    # a range scan of the primary key, one extra row tells if there are more
+    rows = CatalogChange.query.filter(CatalogChange.id > since).order_by(CatalogChange.id).limit(limit + 1).all()
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+
+    # only the last change of every row counts
+    latest = {}
+    for change in rows:
+        latest[(change.entity, change.entity_id)] = change.op
+
+    data = {}
+    for entity, key in [("inventory", "inventories"), ("category", "categories"), ("menu", "menus")]:
+        upserted = [i for (e, i), op in latest.items() if e == entity and op == "upsert"]
+        deleted = [i for (e, i), op in latest.items() if e == entity and op == "delete"]
+        found = catalog_entities(entity, upserted) if upserted else {}
+        data[key] = {
+            "upserts": [found[i] for i in upserted if i in found],
+            # rows deleted by a later change not in this page yet
+            "deletes": deleted + [i for i in upserted if i not in found]
+        }
+
+    data["next"] = rows[-1].id if rows else since
+    data["has_more"] = has_more
+    return success_response(data)
+
+
+# -- EVENT ROUTES---------------------------------------------------
+
+def event_channel(name):
+    """
+    Check that name is "catalog", "orders" or "order:<id>"
+    """
+    if name in ("catalog", "orders"):
+        return name
+    kind, _, order_id = name.partition(":")
+    if kind == "order" and order_id.isdigit():
+        return f"order:{int(order_id)}"
+    raise ValueError(f"Unknown channel: {name}")
+
+
+@app.route("/events/", methods=["GET"])
+def stream_events():
+    """
+    Endpoint streaming Server-Sent Events to clients instead of having
+    them poll. ?channel= may be given several times: "catalog" for
+    catalog_changed events, "orders" for the events of every order and
+    "order:<id>" for those of one order. The stream holds no database
+    connection while it is open
+    """
+    try:
+        channels = sorted({event_channel(name) for name in request.args.getlist("channel")})
+    except ValueError as e:
+        return failure_response(f"{e}", 400)
+    if not channels:
+        return failure_response("Pass at least one ?channel=", 400)
+    if not events.enabled:
+        return failure_response("Events are disabled, EVENTS_BACKEND is none", 503)
+
+    try:
+        subscription = events.subscribe(channels)
+    except TooManySubscribers as e:
+        return failure_response(f"{e}", 503)
+
+    response = Response(events.stream(subscription), mimetype="text/event-stream")
+    response.headers["Cache-Control"] = "no-cache"
+    # nginx would otherwise buffer the stream
+    response.headers["X-Accel-Buffering"] = "no"
+    response.call_on_close(lambda: events.unsubscribe(subscription))
+    return response
+
+
+# -- CACHE ROUTES---------------------------------------------------
+
+@app.route("/cache/stats/", methods=["GET"])
+def get_cache_stats():
+    """
+    Endpoint for getting the response cache hit and miss counters
+    """
+    return success_response(response_cache.stats())
+
+
+# -- METRICS ROUTES---------------------------------------------------
+
+@app.route("/metrics", methods=["GET"])
+def get_metrics():
+    """
+    Endpoint for the request metrics of this process, or of every worker
+    sharing METRICS_DIR, in the Prometheus text format
+    """
+    return metrics.render(), 200, {"Content-Type": "text/plain; version=0.0.4; charset=utf-8"}
+
+
 if __name__ == "__main__":
     port = int(os.environ.get("PORT", 8002))
-    app.run(host="0.0.0.0", port=8002, debug=True)
+    # the debugger and reloader only in development, production runs under gunicorn
+    app.run(host="0.0.0.0", port=port, debug=app.config["DEBUG"])
 
@@ -0,0 +1,320 @@
+"""
+Drive every route of the app through the Flask test client against a
+seeded SQLite database and record the p50/p99 latency and the number of
+SQL statements of each one. The results are compared with
+benchmarks/baseline.json: a route running more statements than its
+baseline, or slower than its baseline p50 beyond the tolerance, fails the
+run with exit code 1.
+
+    python benchmarks/endpoints.py
+    python benchmarks/endpoints.py --inventories 1000 --orders 5000 --update
+
+Latency baselines depend on the machine, record them with --update where
+the benchmark runs (or pass --no-latency to only gate query counts)
+"""
+import argparse
+import io
+import json
+import os
+import random
+import statistics
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from index_lookups import seed
+
+BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "baseline.json")
+
+# endpoints that are not benchmarked, the event stream never ends
+SKIP = {"static", "stream_events"}
+
+
+def png_bytes():
+    from PIL import Image
+    buf = io.BytesIO()
+    Image.new("RGB", (64, 48), (200, 80, 40)).save(buf, "PNG")
+    return buf.getvalue()
+
+
+class Context:
+    """
+    Ids the write routes consume so that every request of the run finds
+    the rows it expects
+    """
+
+    def __init__(self, args, orderitems, empty_orderitems, upload):
+        self.args = args
+        self.rng = random.Random(2)
+        self.orderitems = {"increase": orderitems, "decrease": orderitems, "delete": empty_orderitems}
+        self.upload = upload
+        self.next_menu = args.menus
+        self.next_order = args.orders
+        self.next_pair = {"increase": 0, "decrease": 0, "delete": 0}
+        self.png = png_bytes()
+
+    def inventory(self):
+        return self.rng.randint(1, self.args.inventories)
+
+    def category(self):
+        return self.rng.randint(1, self.args.categories)
+
+    def menu(self):
+        return self.rng.randint(1, self.args.menus // 2)
+
+    def order(self):
+        return self.rng.randint(1, self.args.orders // 2)
+
+    def cart(self):
+        return {"inventories": [{"inventory_id": i, "num_sel": self.rng.randint(1, 3)}
+                                for i in self.rng.sample(range(1, self.args.inventories + 1), 3)]}
+
+    def pop_menu(self):
+        self.next_menu -= 1
+        return self.next_menu + 1
+
+    def pop_order(self):
+        self.next_order -= 1
+        return self.next_order + 1
+
+    def pair(self, kind):
+        # increase and decrease walk the same orderitems so num_sel is restored
+        pair = self.orderitems[kind][self.next_pair[kind]]
+        self.next_pair[kind] += 1
+        return pair
+
+
+def increase_path(ctx):
+    order_id, inventory_id = ctx.pair("increase")
+    return f"/orderitems/{order_id}/{inventory_id}/increase/"
+
+
+def decrease_path(ctx):
+    order_id, inventory_id = ctx.pair("decrease")
+    return f"/orderitems/{order_id}/{inventory_id}/decrease/"
+
+
+def delete_orderitem_path(ctx):
+    order_id, inventory_id = ctx.pair("delete")
+    return f"/orderitems/{order_id}/{inventory_id}/"
+
+
+# (endpoint, method, path, json body or None, heavy)
+# heavy routes return whole tables and run --heavy-repeat times
+ROUTES = [
+    ("greet_user", "GET", lambda ctx: "/", None, False),
+    ("get_inventories", "GET", lambda ctx: "/inventories/", None, True),
+    ("get_inventories", "GET", lambda ctx: f"/inventories/?limit=100&after={ctx.inventory()}", None, False),
+    ("get_inventories", "GET", lambda ctx: f"/inventories/?category={ctx.category()}&sort=-price", None, False),
+    ("get_inventories", "GET", lambda ctx: "/inventories/?sort=name&limit=100", None, False),
+    ("search_inventories", "GET", lambda ctx: f"/inventories/search/?q=inventory+{ctx.inventory()}", None, False),
+    ("test_get_inventories", "GET", lambda ctx: "/test/inventories/", None, True),
+    ("get_catalog_changes", "GET", lambda ctx: "/catalog/changes/?since=0&limit=100", None, False),
+    ("create_inventory", "POST", lambda ctx: "/inventories/",
+     lambda ctx: {"image": "", "name": "bench", "description": "bench", "price": 2.5}, False),
+    ("get_inventory_by_id", "GET", lambda ctx: f"/inventories/{ctx.inventory()}/", None, False),
+    ("assign_category", "POST", lambda ctx: f"/inventories/{ctx.inventory()}/category/",
+     lambda ctx: {"name": f"category {ctx.category()}", "description": ""}, False),
+    ("get_all_categories", "GET", lambda ctx: "/categories/", None, True),
+    ("get_category", "GET", lambda ctx: f"/categories/{ctx.category()}/", None, False),
+    ("get_categories", "GET", lambda ctx: "/categories/m/?ids=" + ",".join(str(ctx.category()) for _ in range(10)),
+     None, False),
+    ("get_menus", "GET", lambda ctx: "/menus/", None, True),
+    ("get_menus", "GET", lambda ctx: f"/menus/?limit=100&after={ctx.menu()}", None, False),
+    ("create_menu", "POST", lambda ctx: "/menus/",
+     lambda ctx: {"name": "bench", "description": "", "instruction": "", "image_id": 1}, False),
+    ("get_menu_by_id", "GET", lambda ctx: f"/menus/{ctx.menu()}/", None, False),
+    ("delete_menu", "DELETE", lambda ctx: f"/menus/{ctx.pop_menu()}/", None, False),
+    ("get_orders", "GET", lambda ctx: "/orders/", None, True),
+    ("get_orders", "GET", lambda ctx: f"/orders/?limit=100&after={ctx.order()}", None, False),
+    ("create_order", "POST", lambda ctx: "/orders/", lambda ctx: ctx.cart(), False),
+    ("get_order_by_id", "GET", lambda ctx: f"/orders/{ctx.order()}/", None, False),
+    ("add_orderitem_to_order", "POST", lambda ctx: f"/orders/{ctx.order()}/",
+     lambda ctx: {"inventory_id": ctx.inventory(), "num_sel": 1}, False),
+    ("sync_order_items", "PUT", lambda ctx: f"/orders/{ctx.order()}/items", lambda ctx: ctx.cart(), False),
+    ("submit_order", "POST", lambda ctx: f"/orders/submit/{ctx.order()}/", lambda ctx: {"user_name": "bench"}, False),
+    ("delete_order", "DELETE", lambda ctx: f"/orders/{ctx.pop_order()}/", None, False),
+    ("get_orderitems", "GET", lambda ctx: "/orderitems/", None, True),
+    ("get_orderitems", "GET", lambda ctx: f"/orderitems/?limit=100&after={ctx.order()}", None, False),
+    ("increase_orderitem", "POST", increase_path, None, False),
+    ("decrease_orderitem", "POST", decrease_path, None, False),
+    ("delete_orderitem", "DELETE", delete_orderitem_path, None, False),
+    ("upload_asset", "POST", lambda ctx: "/assets/", None, False),
+    ("get_upload", "GET", lambda ctx: f"/uploads/{ctx.upload}", None, False),
+    ("get_cache_stats", "GET", lambda ctx: "/cache/stats/", None, False),
+    ("get_metrics", "GET", lambda ctx: "/metrics", None, False),
+]
+
+
+def route_name(endpoint, path):
+    return f"{endpoint} ?{path.split('?', 1)[1].split('=', 1)[0]}" if "?" in path else endpoint
+
+
+def run(client, ctx, args):
+    """
+    Time every route, returns {name: {"queries", "p50_ms", "p99_ms"}}
+    and the list of failed requests
+    """
+    from sqlalchemy import event
+    from sqlalchemy.engine import Engine
+
+    # counted here rather than from X-Query-Count, which misses the
+    # statements run while a streamed body is sent
+    statements = [0]
+
+    def count(*args):
+        statements[0] += 1
+
+    event.listen(Engine, "after_cursor_execute", count)
+    results = {}
+    errors = []
+    for endpoint, method, path_fn, body_fn, heavy in ROUTES:
+        repeat = args.heavy_repeat if heavy else args.repeat
+        timings = []
+        queries = 0
+        name = None
+        # the first request warms up caches and is not recorded
+        for i in range(repeat + 1):
+            path = path_fn(ctx)
+            name = route_name(endpoint, path)
+            kwargs = {}
+            if endpoint == "upload_asset":
+                kwargs = {"data": ctx.png, "content_type": "image/png"}
+            elif body_fn is not None:
+                kwargs = {"data": json.dumps(body_fn(ctx))}
+
+            statements[0] = 0
+            start = time.perf_counter()
+            response = client.open(path, method=method, **kwargs)
+            response.get_data()
+            response.close()
+            elapsed = time.perf_counter() - start
+
+            if response.status_code >= 400:
+                errors.append(f"{method} {path}: {response.status_code}")
+            if i > 0:
+                timings.append(elapsed * 1000)
+                queries = max(queries, statements[0])
+
+        timings.sort()
+        results[name] = {
+            "queries": queries,
+            "p50_ms": round(statistics.median(timings), 3),
+            "p99_ms": round(timings[min(len(timings) - 1, int(len(timings) * 0.99))], 3)
+        }
+    event.remove(Engine, "after_cursor_execute", count)
+    return results, errors
+
+
+def compare(results, baseline, args):
+    """
+    Return the regressions of results against baseline
+    """
+    failures = []
+    for name, result in results.items():
+        expected = baseline.get(name)
+        if expected is None:
+            failures.append(f"{name}: no baseline, run with --update")
+            continue
+        if result["queries"] > expected["queries"]:
+            failures.append(f"{name}: {result['queries']} queries, budget is {expected['queries']}")
+        limit = expected["p50_ms"] * (1 + args.tolerance) + args.slack_ms
+        if not args.no_latency and result["p50_ms"] > limit:
+            failures.append(f"{name}: p50 {result['p50_ms']:.1f}ms, baseline is {expected['p50_ms']:.1f}ms")
+    return failures
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--inventories", type=int, default=10000)
+    parser.add_argument("--categories", type=int, default=200)
+    parser.add_argument("--menus", type=int, default=500)
+    parser.add_argument("--orders", type=int, default=100000)
+    parser.add_argument("--items-per-order", type=int, default=3)
+    parser.add_argument("--repeat", type=int, default=50)
+    parser.add_argument("--heavy-repeat", type=int, default=3)
+    parser.add_argument("--baseline", default=BASELINE)
+    parser.add_argument("--update", action="store_true", help="record the results as the new baseline")
+    parser.add_argument("--tolerance", type=float, default=0.5, help="allowed p50 slowdown, 0.5 is 50%%")
+    parser.add_argument("--slack-ms", type=float, default=2.0, help="allowed p50 slowdown in ms on top of it")
+    parser.add_argument("--no-latency", action="store_true", help="only gate query counts")
+    args = parser.parse_args()
+
+    tmp = tempfile.TemporaryDirectory()
+    # the app reads its configuration when it is imported
+    os.environ.setdefault("APP_ENV", "production")
+    os.environ["DATABASE_URL"] = f"sqlite:///{os.path.join(tmp.name, 'bench.db')}"
+    os.environ["DATABASE_REPLICA_URLS"] = ""
+    os.environ["CACHE_BACKEND"] = "none"
+    os.environ["STORAGE_BACKEND"] = "local"
+    os.environ["LOCAL_STORAGE_DIR"] = os.path.join(tmp.name, "uploads")
+    os.environ["UPLOAD_WORKERS"] = "0"
+    os.environ["ASSET_VARIANTS"] = ""
+    os.environ["QUERY_BUDGET"] = "0"
+    os.environ.pop("PROFILE_TOKEN", None)
+    os.environ.setdefault("NAME", "bench")
+
+    from sqlalchemy import text
+    from app import app
+    from db import db
+
+    print(f"seeding {args.inventories} inventories, {args.categories} categories, "
+          f"{args.menus} menus and {args.orders} orders", file=sys.stderr)
+    with app.app_context():
+        seed(db.engine, args)
+        with db.engine.begin() as conn:
+            conn.execute(text("ANALYZE"))
+            # orderitems of orders the other write routes leave alone,
+            # DELETE only removes orderitems whose num_sel dropped to 0
+            select_pairs = text(
+                "SELECT order_id, inventory_id FROM orderitem WHERE order_id > :low AND order_id <= :high ORDER BY id"
+            )
+            orderitems = [tuple(row) for row in conn.execute(
+                select_pairs, {"low": args.orders // 2, "high": args.orders * 5 // 8})]
+            empty_orderitems = [tuple(row) for row in conn.execute(
+                select_pairs, {"low": args.orders * 5 // 8, "high": args.orders * 3 // 4})]
+            conn.execute(text("UPDATE orderitem SET num_sel = 0 WHERE order_id > :low AND order_id <= :high"),
+                         {"low": args.orders * 5 // 8, "high": args.orders * 3 // 4})
+
+    client = app.test_client()
+    response = client.post("/assets/", data=png_bytes(), content_type="image/png")
+    upload = json.loads(response.data)["url"].rsplit("/", 1)[1]
+    ctx = Context(args, orderitems, empty_orderitems, upload)
+
+    endpoints = {rule.endpoint for rule in app.url_map.iter_rules()} - SKIP
+    missing = endpoints - {route[0] for route in ROUTES}
+
+    results, errors = run(client, ctx, args)
+    tmp.cleanup()
+
+    print(f"{'route':40} {'queries':>8} {'p50 (ms)':>10} {'p99 (ms)':>10}")
+    for name, result in results.items():
+        print(f"{name:40} {result['queries']:8} {result['p50_ms']:10.2f} {result['p99_ms']:10.2f}")
+
+    failures = [f"{e}: not benchmarked, add it to ROUTES" for e in sorted(missing)]
+    failures += [f"request failed: {e}" for e in errors[:20]]
+    scale = {k: getattr(args, k) for k in ("inventories", "categories", "menus", "orders", "items_per_order")}
+    if args.update:
+        with open(args.baseline, "w") as f:
+            json.dump({"scale": scale, "routes": results}, f, indent=2, sort_keys=True)
+            f.write("\n")
+        print(f"baseline written to {args.baseline}")
+    elif os.path.exists(args.baseline):
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        if baseline["scale"] != scale:
+            failures.append(f"baseline was recorded at {baseline['scale']}, run at that scale or --update")
+        else:
+            failures += compare(results, baseline["routes"], args)
+    else:
+        failures.append(f"no baseline at {args.baseline}, run with --update")
+
+    for failure in failures:
+        print(f"FAIL {failure}")
+    sys.exit(1 if failures else 0)
+
+
+if __name__ == "__main__":
+    main()
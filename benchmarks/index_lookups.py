@@ -0,0 +1,122 @@
+"""
+Measure the hot lookups of the app on a seeded SQLite database, first
+without the secondary indexes declared in db.py and then with them.
+
+    python benchmarks/index_lookups.py --orders 20000
+"""
+import argparse
+import datetime
+import os
+import random
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from sqlalchemy import create_engine, text
+
+from db import db
+from migrations import create_index
+
+LOOKUPS = [
+    ("orderitem by (order_id, inventory_id)",
+     "SELECT * FROM orderitem WHERE order_id = :order_id AND inventory_id = :inventory_id"),
+    ("orderitem by inventory_id",
+     "SELECT * FROM orderitem WHERE inventory_id = :inventory_id"),
+    ("category by name",
+     "SELECT * FROM category WHERE name = :category_name"),
+    ("association_category by category_id",
+     "SELECT inventory_id FROM association_category WHERE category_id = :category_id"),
+    ("association_menu by menu_id",
+     "SELECT inventory_id FROM association_menu WHERE menu_id = :menu_id"),
+    ("order by valid and pick_up_by",
+     "SELECT id FROM \"order\" WHERE valid = 1 AND pick_up_by < :pick_up_by"),
+]
+
+
+def seed(engine, args):
+    now = datetime.datetime.now()
+    rng = random.Random(0)
+    with engine.begin() as conn:
+        conn.execute(text("INSERT INTO inventory (id, image, name, description, price) VALUES (:id, '', :name, '', 1.0)"),
+                     [{"id": i, "name": f"inventory {i}"} for i in range(1, args.inventories + 1)])
+        conn.execute(text("INSERT INTO category (id, name, description) VALUES (:id, :name, '')"),
+                     [{"id": i, "name": f"category {i}"} for i in range(1, args.categories + 1)])
+        conn.execute(text("INSERT INTO association_category (inventory_id, category_id) VALUES (:i, :c)"),
+                     [{"i": i, "c": rng.randint(1, args.categories)} for i in range(1, args.inventories + 1)])
+        conn.execute(text("INSERT INTO assets (id, salt, extension, width, height, created_at) VALUES (1, '', 'png', 1, 1, :now)"),
+                     {"now": now})
+        conn.execute(text("INSERT INTO menu (id, name, description, instruction, image_id) VALUES (:id, '', '', '', 1)"),
+                     [{"id": i} for i in range(1, args.menus + 1)])
+        conn.execute(text("INSERT INTO association_menu (inventory_id, menu_id) VALUES (:i, :m)"),
+                     [{"i": rng.randint(1, args.inventories), "m": m} for m in range(1, args.menus + 1) for _ in range(5)])
+        conn.execute(text("INSERT INTO \"order\" (id, time_created, pick_up_by, total_price, valid) VALUES (:id, :t, :p, 0, :v)"),
+                     [{"id": o, "t": now, "p": now + datetime.timedelta(minutes=rng.randint(-5000, 5000)), "v": o % 2}
+                      for o in range(1, args.orders + 1)])
+        conn.execute(text("INSERT INTO orderitem (num_sel, inventory_id, order_id) VALUES (1, :i, :o)"),
+                     [{"i": i, "o": o} for o in range(1, args.orders + 1)
+                      for i in rng.sample(range(1, args.inventories + 1), args.items_per_order)])
+
+
+def run_lookups(engine, args):
+    rng = random.Random(1)
+    now = datetime.datetime.now()
+    results = {}
+    with engine.connect() as conn:
+        for name, sql in LOOKUPS:
+            plan = " / ".join(row[-1] for row in conn.execute(text("EXPLAIN QUERY PLAN " + sql), params(rng, args, now)))
+            start = time.perf_counter()
+            for _ in range(args.repeat):
+                conn.execute(text(sql), params(rng, args, now)).fetchall()
+            results[name] = ((time.perf_counter() - start) / args.repeat * 1e6, plan)
+    return results
+
+
+def params(rng, args, now):
+    return {
+        "order_id": rng.randint(1, args.orders),
+        "inventory_id": rng.randint(1, args.inventories),
+        "category_name": f"category {rng.randint(1, args.categories)}",
+        "category_id": rng.randint(1, args.categories),
+        "menu_id": rng.randint(1, args.menus),
+        "pick_up_by": now - datetime.timedelta(minutes=4900)
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--inventories", type=int, default=5000)
+    parser.add_argument("--categories", type=int, default=200)
+    parser.add_argument("--menus", type=int, default=500)
+    parser.add_argument("--orders", type=int, default=20000)
+    parser.add_argument("--items-per-order", type=int, default=5)
+    parser.add_argument("--repeat", type=int, default=200)
+    args = parser.parse_args()
+
+    index_names = [index.name for table in db.metadata.tables.values() for index in table.indexes]
+    with tempfile.TemporaryDirectory() as tmp:
+        engine = create_engine(f"sqlite:///{os.path.join(tmp, 'bench.db')}")
+        db.metadata.create_all(engine)
+        with engine.begin() as conn:
+            for name in index_names:
+                conn.execute(text(f"DROP INDEX {name}"))
+        seed(engine, args)
+
+        before = run_lookups(engine, args)
+        with engine.begin() as conn:
+            for name in index_names:
+                create_index(conn, name)
+            conn.execute(text("ANALYZE"))
+        after = run_lookups(engine, args)
+
+    print(f"{'lookup':40} {'before (us)':>12} {'after (us)':>12} {'speedup':>8}")
+    for name, _ in LOOKUPS:
+        b, a = before[name][0], after[name][0]
+        print(f"{name:40} {b:12.1f} {a:12.1f} {b / a:7.1f}x")
+        print(f"    before: {before[name][1]}")
+        print(f"    after:  {after[name][1]}")
+
+
+if __name__ == "__main__":
+    main()
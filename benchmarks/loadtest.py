@@ -0,0 +1,277 @@
+"""
+Load test of the shopping journey: concurrent shoppers browse
+/inventories/ and /menus/, create an order, increase and decrease one of
+its orderitems and submit it, over and over.
+
+By default the app is started locally on a seeded SQLite database, once
+for every --workers count, under gunicorn with that many gevent worker
+processes as the production image runs it. For every run the requests
+per second, error rate and latency percentiles of each step are reported,
+together with the "database is locked" errors logged by the workers, to
+pick the number of workers a database can take.
+
+    python benchmarks/loadtest.py --workers 1 2 4 --shoppers 32 --duration 30
+    python benchmarks/loadtest.py --url http://localhost:8002 --shoppers 8
+
+Only the standard library is used on the client side
+"""
+import argparse
+import json
+import os
+import random
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.error
+import urllib.request
+from collections import defaultdict
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from index_lookups import seed
+
+STEPS = ["browse_inventories", "browse_menus", "create_order", "increase", "decrease", "submit"]
+LOCKED = "database is locked"
+
+# the server of the Dockerfile, gunicorn only logs errors by default
+SERVER = [sys.executable, "-m", "gunicorn", "--preload", "--worker-class", "gevent",
+          "--worker-connections", "10000", "--graceful-timeout", "5"]
+
+
+class Stats:
+    """
+    Latencies and errors of every step, shared by the shopper threads
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.latencies = defaultdict(list)
+        self.errors = defaultdict(int)
+        self.locked = 0
+
+    def record(self, step, elapsed, ok, body=b""):
+        with self.lock:
+            self.latencies[step].append(elapsed)
+            if not ok:
+                self.errors[step] += 1
+                if LOCKED.encode() in body:
+                    self.locked += 1
+
+
+def request(base_url, method, path, body=None, timeout=30):
+    """
+    Send one request, returns (status, body), status 0 on connection errors
+    """
+    data = json.dumps(body).encode() if body is not None else None
+    # urllib would send bodies as a form, which the app would not see in request.data
+    headers = {"Content-Type": "application/json"} if data is not None else {}
+    req = urllib.request.Request(base_url + path, data=data, method=method, headers=headers)
+    try:
+        with urllib.request.urlopen(req, timeout=timeout) as response:
+            return response.status, response.read()
+    except urllib.error.HTTPError as e:
+        return e.code, e.read()
+    except (urllib.error.URLError, OSError) as e:
+        return 0, str(e).encode()
+
+
+def shopper(n, base_urls, args, stats, deadline):
+    rng = random.Random(n)
+    while time.time() < deadline:
+        base_url = rng.choice(base_urls)
+
+        def step(name, method, path, body=None):
+            start = time.perf_counter()
+            status, data = request(base_url, method, path, body)
+            stats.record(name, time.perf_counter() - start, 200 <= status < 300, data)
+            return status, data
+
+        page = f"?limit={args.page_size}" if args.page_size else ""
+        step("browse_inventories", "GET", f"/inventories/{page}")
+        step("browse_menus", "GET", f"/menus/{page}")
+
+        cart = rng.sample(range(1, args.inventories + 1), args.cart_size)
+        status, data = step("create_order", "POST", "/orders/", {
+            "inventories": [{"inventory_id": i, "num_sel": rng.randint(1, 3)} for i in cart]
+        })
+        if status != 201:
+            continue
+        order_id = json.loads(data)["id"]
+
+        step("increase", "POST", f"/orderitems/{order_id}/{rng.choice(cart)}/increase/")
+        step("decrease", "POST", f"/orderitems/{order_id}/{rng.choice(cart)}/decrease/")
+        step("submit", "POST", f"/orders/submit/{order_id}/", {"user_name": f"shopper {n}"})
+
+
+def run_shoppers(base_urls, args):
+    stats = Stats()
+    deadline = time.time() + args.duration
+    threads = [threading.Thread(target=shopper, args=(n, base_urls, args, stats, deadline))
+               for n in range(args.shoppers)]
+    start = time.perf_counter()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    return stats, time.perf_counter() - start
+
+
+def percentile(values, p):
+    return values[min(len(values) - 1, int(len(values) * p))] * 1000
+
+
+def report(stats, elapsed):
+    """
+    Print the table of one run, returns its totals
+    """
+    print(f"{'step':20} {'requests':>9} {'req/s':>8} {'errors':>8} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8} {'max ms':>8}")
+    total = errors = 0
+    tail = []
+    for name in STEPS:
+        latencies = sorted(stats.latencies[name])
+        if not latencies:
+            continue
+        total += len(latencies)
+        errors += stats.errors[name]
+        tail += latencies
+        print(f"{name:20} {len(latencies):9} {len(latencies) / elapsed:8.1f} "
+              f"{100 * stats.errors[name] / len(latencies):7.1f}% "
+              f"{percentile(latencies, 0.5):8.1f} {percentile(latencies, 0.95):8.1f} "
+              f"{percentile(latencies, 0.99):8.1f} {latencies[-1] * 1000:8.1f}")
+    tail.sort()
+    return {
+        "rps": total / elapsed,
+        "error_rate": errors / total if total else 0,
+        "p99_ms": percentile(tail, 0.99) if tail else 0
+    }
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def start_server(count, env, log_dir):
+    """
+    Start gunicorn with count workers, returns it with its url and log
+    """
+    port = free_port()
+    log = open(os.path.join(log_dir, f"server{count}.log"), "w+")
+    process = subprocess.Popen(SERVER + ["--workers", str(count), "--bind", f"127.0.0.1:{port}", "wsgi:app"],
+                               cwd=ROOT, env=env, stdout=log, stderr=subprocess.STDOUT)
+    server = (process, f"http://127.0.0.1:{port}", log)
+
+    for _ in range(300):
+        if process.poll() is not None:
+            log.seek(0)
+            raise RuntimeError(f"server exited:\n{log.read()}")
+        if request(server[1], "GET", "/metrics", timeout=1)[0] == 200:
+            return server
+        time.sleep(0.1)
+    stop_server(server)
+    raise RuntimeError(f"server at {server[1]} did not start")
+
+
+def stop_server(server):
+    """
+    Stop the server, returns the number of lock errors in its log
+    """
+    process, url, log = server
+    process.terminate()
+    process.wait()
+    log.seek(0)
+    # one line per failed request, the chained sqlite3 error repeats it
+    locked = sum(1 for line in log.read().splitlines()
+                 if line.startswith("sqlalchemy.exc.OperationalError") and LOCKED in line)
+    log.close()
+    return locked
+
+
+def seed_database(path, args):
+    from sqlalchemy import create_engine, text
+
+    from db import db
+    from migrations import upgrade
+
+    engine = create_engine(f"sqlite:///{path}")
+    db.metadata.create_all(engine)
+    upgrade(engine)
+    seed(engine, args)
+    with engine.begin() as conn:
+        conn.execute(text("ANALYZE"))
+    engine.dispose()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--url", help="load an already running server instead of starting one")
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, 2, 4],
+                        help="gunicorn worker counts to run the scenario with")
+    parser.add_argument("--shoppers", type=int, default=16)
+    parser.add_argument("--duration", type=float, default=20, help="seconds per run")
+    parser.add_argument("--cart-size", type=int, default=3)
+    parser.add_argument("--page-size", type=int, default=100, help="browse pages of this size, 0 for the full lists")
+    parser.add_argument("--inventories", type=int, default=2000)
+    parser.add_argument("--categories", type=int, default=50)
+    parser.add_argument("--menus", type=int, default=100)
+    parser.add_argument("--orders", type=int, default=10000)
+    parser.add_argument("--items-per-order", type=int, default=3)
+    args = parser.parse_args()
+
+    if args.url:
+        stats, elapsed = run_shoppers([args.url.rstrip("/")], args)
+        report(stats, elapsed)
+        if stats.locked:
+            print(f"WARNING {stats.locked} responses reported '{LOCKED}'")
+        return
+
+    tmp = tempfile.mkdtemp()
+    try:
+        template = os.path.join(tmp, "seed.db")
+        print(f"seeding {args.inventories} inventories and {args.orders} orders", file=sys.stderr)
+        seed_database(template, args)
+
+        summary = []
+        for count in args.workers:
+            database = os.path.join(tmp, f"run{count}.db")
+            shutil.copy(template, database)
+            env = dict(
+                os.environ,
+                APP_ENV=os.environ.get("APP_ENV", "production"),
+                DATABASE_URL=f"sqlite:///{database}",
+                CACHE_BACKEND=os.environ.get("CACHE_BACKEND", "none"),
+                STORAGE_BACKEND="local",
+                LOCAL_STORAGE_DIR=os.path.join(tmp, "uploads"),
+                DATABASE_REPLICA_URLS="",
+                NAME="loadtest"
+            )
+            env.pop("PROFILE_TOKEN", None)
+
+            server = start_server(count, env, tmp)
+            try:
+                print(f"\n{count} worker(s), {args.shoppers} shoppers, {args.duration:.0f}s")
+                stats, elapsed = run_shoppers([server[1]], args)
+            finally:
+                locked = stop_server(server)
+            totals = report(stats, elapsed)
+            totals["locked"] = max(locked, stats.locked)
+            summary.append((count, totals))
+            if totals["locked"]:
+                print(f"WARNING {totals['locked']} '{LOCKED}' errors, the workers contend for the SQLite write lock")
+    finally:
+        shutil.rmtree(tmp, ignore_errors=True)
+
+    print(f"\n{'workers':>8} {'req/s':>8} {'errors':>8} {'p99 ms':>8} {'locked':>8}")
+    for count, totals in summary:
+        print(f"{count:8} {totals['rps']:8.1f} {100 * totals['error_rate']:7.1f}% "
+              f"{totals['p99_ms']:8.1f} {totals['locked']:8}")
+
+
+if __name__ == "__main__":
+    main()
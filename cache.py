@@ -0,0 +1,225 @@
+import threading
+import time
+from collections import OrderedDict
+from functools import wraps
+
+from flask import make_response, request
+from werkzeug.http import generate_etag
+
+from routing import reading_from_replica
+
+try:
+    import redis
+except ImportError:
+    redis = None
+
+
+def tagged_response(body, etag):
+    response = make_response(body, 200)
+    response.set_etag(etag)
+    return response
+
+
+def conditional(view):
+    """
+    Decorator giving successful responses of a view a strong ETag
+    and answering a matching If-None-Match with 304 Not Modified.
+    Responses coming out of the ResponseCache already carry their ETag,
+    so a cache hit is answered without serializing or hashing anything
+    """
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        response = make_response(view(*args, **kwargs))
+        if response.status_code == 200:
+            if response.get_etag()[0] is None:
+                response.add_etag()
+            response.make_conditional(request)
+        return response
+    return wrapper
+
+
+class MemoryBackend:
+    """
+    In-process LRU cache with a time to live on every entry.
+    Versions live in this process only, so every worker process that
+    serves catalog writes must share a RedisBackend instead
+    """
+
+    def __init__(self, max_entries=1024, ttl=300):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.versions = {}
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+            expires_at, value = entry
+            if expires_at < time.monotonic():
+                del self.entries[key]
+                return None
+            self.entries.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        with self.lock:
+            self.entries[key] = (time.monotonic() + self.ttl, value)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def version(self, namespace):
+        with self.lock:
+            return self.versions.get(namespace, 0)
+
+    def bump(self, namespace):
+        with self.lock:
+            self.versions[namespace] = self.versions.get(namespace, 0) + 1
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+
+class RedisBackend:
+    """
+    Cache stored in Redis (or anything speaking its protocol), shared by
+    every worker process. Versions are Redis counters, so a write in one
+    worker invalidates the entries of all of them
+    """
+
+    def __init__(self, url, ttl=300, prefix="anabels:cache:"):
+        if redis is None:
+            raise RuntimeError("CACHE_BACKEND is redis but the redis package is not installed")
+        self.client = redis.Redis.from_url(url)
+        self.ttl = ttl
+        self.prefix = prefix
+
+    def get(self, key):
+        value = self.client.get(self.prefix + key)
+        if value is None:
+            return None
+        return value.decode()
+
+    def set(self, key, value):
+        self.client.set(self.prefix + key, value, ex=self.ttl)
+
+    def version(self, namespace):
+        return int(self.client.get(f"{self.prefix}version:{namespace}") or 0)
+
+    def bump(self, namespace):
+        self.client.incr(f"{self.prefix}version:{namespace}")
+
+    def clear(self):
+        for key in self.client.scan_iter(f"{self.prefix}*"):
+            self.client.delete(key)
+
+
+class ResponseCache:
+    """
+    Read-through cache for serialized GET responses.
+    Every entry is keyed by the request path and the current version of
+    the namespaces the response depends on ("catalog", "orders"); write
+    routes bump those versions, so entries written before the write can
+    never be read again
+    """
+
+    def __init__(self, app=None):
+        self.backend = None
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        """
+        Configure the backend from CACHE_BACKEND ("memory", "redis" or "none"),
+        CACHE_TTL, CACHE_MAX_ENTRIES and CACHE_REDIS_URL. CACHE_ALLOW_MEMORY
+        off refuses the memory backend, for profiles running several workers
+        """
+        backend = app.config.get("CACHE_BACKEND", "memory")
+        ttl = int(app.config.get("CACHE_TTL", 300))
+        if backend == "memory" and not app.config.get("CACHE_ALLOW_MEMORY", True):
+            raise RuntimeError("CACHE_BACKEND memory is only invalidated in its own process, use redis or none")
+        if backend == "memory":
+            self.backend = MemoryBackend(int(app.config.get("CACHE_MAX_ENTRIES", 1024)), ttl)
+        elif backend == "redis":
+            self.backend = RedisBackend(app.config.get("CACHE_REDIS_URL", "redis://localhost:6379/0"), ttl)
+        elif backend == "none":
+            self.backend = None
+        else:
+            raise RuntimeError(f"Unknown CACHE_BACKEND: {backend}")
+
+    def key(self, namespaces):
+        versions = ",".join(f"{n}={self.backend.version(n)}" for n in namespaces)
+        return f"{request.full_path}|{versions}"
+
+    def cached(self, *namespaces):
+        """
+        Decorator caching the body of successful responses of a view
+        until one of namespaces is invalidated
+        """
+        def decorator(view):
+            @wraps(view)
+            def wrapper(*args, **kwargs):
+                if self.backend is None:
+                    return view(*args, **kwargs)
+
+                # read the versions before the view runs, so a response built
+                # from data older than a concurrent write lands under a stale key
+                key = self.key(namespaces)
+                entry = self.backend.get(key)
+                if entry is not None:
+                    self.count(hit=True)
+                    # entries are stored as "<etag>\n<body>"
+                    etag, body = entry.split("\n", 1)
+                    return tagged_response(body, etag)
+
+                self.count(hit=False)
+                body, code = view(*args, **kwargs)
+                if code != 200:
+                    return body, code
+                etag = generate_etag(body.encode())
+                # a replica can lag behind the write that bumped the versions,
+                # its responses would be served as current to every client
+                if not reading_from_replica():
+                    self.backend.set(key, f"{etag}\n{body}")
+                return tagged_response(body, etag)
+            return wrapper
+        return decorator
+
+    def invalidates(self, *namespaces):
+        """
+        Decorator bumping the versions of namespaces after a view
+        has successfully written to them
+        """
+        def decorator(view):
+            @wraps(view)
+            def wrapper(*args, **kwargs):
+                body, code = view(*args, **kwargs)
+                if code < 400:
+                    self.invalidate(*namespaces)
+                return body, code
+            return wrapper
+        return decorator
+
+    def invalidate(self, *namespaces):
+        if self.backend is None:
+            return
+        for namespace in namespaces:
+            self.backend.bump(namespace)
+
+    def count(self, hit):
+        with self.lock:
+            if hit:
+                self.hits += 1
+            else:
+                self.misses += 1
+
+    def stats(self):
+        with self.lock:
+            return {"hits": self.hits, "misses": self.misses}
@@ -0,0 +1,115 @@
+import datetime
+
+from sqlalchemy import event, insert, inspect, select, text
+
+from db import CatalogChange
+from db import Category
+from db import Inventory
+from db import Menu
+from routing import RoutingSession
+
+# entity name recorded for every catalog model
+CATALOG_ENTITIES = {
+    Inventory: "inventory",
+    Category: "category",
+    Menu: "menu"
+}
+
+# called with the {(entity, id): op} changes of every committed transaction
+commit_listeners = []
+
+# attributes whose changes don't change what clients sync
+IGNORED_ATTRIBUTES = {
+    Inventory: {"order_items"}
+}
+
+
+def is_changed(obj):
+    ignored = IGNORED_ATTRIBUTES.get(type(obj), set())
+    return any(
+        attr.history.has_changes()
+        for attr in inspect(obj).attrs
+        if attr.key not in ignored
+    )
+
+
+@event.listens_for(RoutingSession, "after_flush")
+def record_catalog_changes(session, flush_context):
+    """
+    Log every inventory, category and menu inserted, updated or deleted
+    by a flush to catalog_change, in the same transaction
+    """
+    changes = {}
+    for obj in session.new:
+        if type(obj) in CATALOG_ENTITIES:
+            changes[(CATALOG_ENTITIES[type(obj)], obj.id)] = "upsert"
+    for obj in session.dirty:
+        if type(obj) in CATALOG_ENTITIES and is_changed(obj):
+            changes[(CATALOG_ENTITIES[type(obj)], obj.id)] = "upsert"
+    for obj in session.deleted:
+        if type(obj) in CATALOG_ENTITIES:
+            changes[(CATALOG_ENTITIES[type(obj)], obj.id)] = "delete"
+    if changes:
+        log_changes(session, changes)
+
+
+def lock_change_log(connection):
+    """
+    Make catalog_change ids commit in the order they were assigned, as
+    clients sync past every id they were sent. SQLite already runs one
+    writer at a time; on PostgreSQL concurrent transactions would draw
+    ids and commit in any order, so writers of the log take turns until
+    they commit. Other databases are not supported
+    """
+    dialect = connection.dialect.name
+    if dialect == "postgresql":
+        connection.execute(text("LOCK TABLE catalog_change IN EXCLUSIVE MODE"))
+    elif dialect != "sqlite":
+        raise RuntimeError(f"catalog_change ids don't follow commit order on {dialect}")
+
+
+def log_changes(session, changes):
+    """
+    Insert {(entity, id): op} changes into catalog_change, and keep them
+    to be published once the transaction commits
+    """
+    session.info.setdefault("catalog_changes", {}).update(changes)
+    now = datetime.datetime.now()
+    # through the connection, executing on the session would autoflush
+    connection = session.connection()
+    lock_change_log(connection)
+    connection.execute(insert(CatalogChange), [
+        {"entity": entity, "entity_id": entity_id, "op": op, "changed_at": now}
+        for (entity, entity_id), op in changes.items()
+    ])
+
+
+def on_commit(listener):
+    """
+    Call listener with the catalog changes of every committed transaction
+    """
+    commit_listeners.append(listener)
+    return listener
+
+
+@event.listens_for(RoutingSession, "after_commit")
+def publish_catalog_changes(session):
+    changes = session.info.pop("catalog_changes", None)
+    if changes:
+        for listener in commit_listeners:
+            listener(changes)
+
+
+@event.listens_for(RoutingSession, "after_soft_rollback")
+def discard_catalog_changes(session, previous_transaction):
+    session.info.pop("catalog_changes", None)
+
+
+def record_image_change(session, asset_id):
+    """
+    Log an upsert of every menu showing the image asset_id, whose status
+    or variants were changed without going through the ORM
+    """
+    menu_ids = session.execute(select(Menu.id).where(Menu.image_id == asset_id)).scalars().all()
+    if menu_ids:
+        log_changes(session, {("menu", menu_id): "upsert" for menu_id in menu_ids})
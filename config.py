@@ -0,0 +1,220 @@
+import os
+
+from flask import has_request_context, request
+from sqlalchemy import event
+from sqlalchemy.engine import make_url
+from sqlalchemy.pool import QueuePool
+
+
+def normalize_url(url):
+    """
+    Accept Heroku style postgres:// URLs
+    """
+    if url.startswith("postgres://"):
+        url = "postgresql://" + url[len("postgres://"):]
+    return url
+
+
+def database_url():
+    """
+    DATABASE_URL from the environment, sqlite:///todo.db by default
+    """
+    return normalize_url(os.environ.get("DATABASE_URL", "sqlite:///todo.db"))
+
+
+def replica_urls():
+    """
+    Comma separated DATABASE_REPLICA_URLS from the environment
+    """
+    urls = os.environ.get("DATABASE_REPLICA_URLS", "")
+    return [normalize_url(u.strip()) for u in urls.split(",") if u.strip()]
+
+
+class Config:
+    """
+    Settings shared by every profile, most can be overridden
+    through environment variables of the same name
+    """
+    SQLALCHEMY_DATABASE_URI = database_url()
+    SQLALCHEMY_TRACK_MODIFICATIONS = False  #has event listener feature to track the files modified
+    SQLALCHEMY_ECHO = False
+    # connection pool, SQLite is pooled too so that connections (and their
+    # pragmas) are reused instead of opened for every request
+    DB_POOL_SIZE = int(os.environ.get("DB_POOL_SIZE", 5))
+    DB_MAX_OVERFLOW = int(os.environ.get("DB_MAX_OVERFLOW", 10))
+    DB_POOL_RECYCLE = int(os.environ.get("DB_POOL_RECYCLE", 1800))
+    # PRAGMAs run on every new SQLite connection
+    SQLITE_PRAGMAS = {}
+    # take the SQLite write lock when a write request starts its transaction,
+    # instead of failing to upgrade a read lock when another worker committed
+    SQLITE_BEGIN_IMMEDIATE = False
+    # read replicas serving GET requests, none by default
+    DATABASE_REPLICA_URLS = replica_urls()
+    # how long a client reads from the primary after one of its writes
+    READ_YOUR_WRITES_SECONDS = int(os.environ.get("READ_YOUR_WRITES_SECONDS", 5))
+
+    # requests running more SQL statements than this are logged and
+    # flagged in /metrics, 0 disables the check
+    QUERY_BUDGET = int(os.environ.get("QUERY_BUDGET", 20))
+    # directory shared by the worker processes, /metrics then reports all
+    # of them instead of the worker answering it. Unset keeps them apart
+    METRICS_DIR = os.environ.get("METRICS_DIR")
+    # seconds between the snapshots every worker writes there
+    METRICS_WRITE_INTERVAL = float(os.environ.get("METRICS_WRITE_INTERVAL", 1))
+
+    # requests sent with this token in an X-Profile header or a ?profile=
+    # argument are profiled, unset disables profiling entirely
+    PROFILE_TOKEN = os.environ.get("PROFILE_TOKEN")
+    # defaults to the profiles folder of the instance path
+    PROFILE_DIR = os.environ.get("PROFILE_DIR")
+    # sampling interval in milliseconds
+    PROFILE_INTERVAL = float(os.environ.get("PROFILE_INTERVAL", 1))
+
+    # response cache for catalog reads: "memory", "redis" (shared by all workers) or "none"
+    CACHE_BACKEND = os.environ.get("CACHE_BACKEND", "memory")
+    CACHE_TTL = int(os.environ.get("CACHE_TTL", 300))
+    CACHE_MAX_ENTRIES = int(os.environ.get("CACHE_MAX_ENTRIES", 1024))
+    CACHE_REDIS_URL = os.environ.get("CACHE_REDIS_URL", "redis://localhost:6379/0")
+
+    # pub/sub behind GET /events/: "memory" (this process only), "redis"
+    # (all workers) or "none" (GET /events/ answers 503)
+    EVENTS_BACKEND = os.environ.get("EVENTS_BACKEND", "memory")
+    EVENTS_REDIS_URL = os.environ.get("EVENTS_REDIS_URL", CACHE_REDIS_URL)
+    # open event streams per worker process, more are answered with 503
+    EVENTS_MAX_SUBSCRIBERS = int(os.environ.get("EVENTS_MAX_SUBSCRIBERS", 10000))
+    # events waiting for one client before it is disconnected
+    EVENTS_QUEUE_SIZE = int(os.environ.get("EVENTS_QUEUE_SIZE", 100))
+    # seconds between keep-alive comments on idle streams
+    EVENTS_HEARTBEAT = float(os.environ.get("EVENTS_HEARTBEAT", 15))
+
+    # image storage: "s3" or "local" (a directory served under /uploads/)
+    STORAGE_BACKEND = os.environ.get("STORAGE_BACKEND", "s3")
+    S3_BUCKET_NAME = os.environ.get("S3_BUCKET_NAME")
+    S3_REGION = os.environ.get("S3_REGION", "us-east-1")
+    S3_ENDPOINT_URL = os.environ.get("S3_ENDPOINT_URL")
+    # defaults to the uploads folder of the instance path
+    LOCAL_STORAGE_DIR = os.environ.get("LOCAL_STORAGE_DIR")
+    # number of background upload threads, 0 uploads inside the request
+    UPLOAD_WORKERS = int(os.environ.get("UPLOAD_WORKERS", 4))
+    # largest image accepted by POST /assets/, in bytes
+    MAX_IMAGE_SIZE = int(os.environ.get("MAX_IMAGE_SIZE", 10 * 1024 * 1024))
+    # resized copies made of every uploaded image, as "key:width" pairs
+    ASSET_VARIANTS = os.environ.get("ASSET_VARIANTS", "thumb:160,small:320,medium:640")
+    ASSET_VARIANT_FORMATS = os.environ.get("ASSET_VARIANT_FORMATS", "webp,jpeg")
+    # processes rendering the variants, 0 renders them on the upload thread
+    DERIVATIVE_PROCESSES = int(os.environ.get("DERIVATIVE_PROCESSES", os.cpu_count() or 1))
+
+
+class DevelopmentConfig(Config):
+    """
+    Local development, logs every SQL statement
+    """
+    DEBUG = True
+    SQLALCHEMY_ECHO = os.environ.get("SQLALCHEMY_ECHO", "1") == "1"
+
+
+class ProductionConfig(Config):
+    """
+    Several worker processes sharing one database
+    """
+    DEBUG = False
+    SQLALCHEMY_ECHO = False
+    SQLITE_PRAGMAS = {
+        "journal_mode": "WAL",
+        "synchronous": "NORMAL",
+        "busy_timeout": int(os.environ.get("SQLITE_BUSY_TIMEOUT", 5000))
+    }
+    SQLITE_BEGIN_IMMEDIATE = True
+    # the memory cache keeps its versions in one process, a write in one
+    # worker would leave the others serving stale entries. Only the shared
+    # redis backend is safe, it is used when CACHE_REDIS_URL is set
+    CACHE_BACKEND = os.environ.get("CACHE_BACKEND", "redis" if "CACHE_REDIS_URL" in os.environ else "none")
+    CACHE_ALLOW_MEMORY = False
+    # same for events, a memory bus only reaches the streams of the worker
+    # that made the change
+    EVENTS_BACKEND = os.environ.get(
+        "EVENTS_BACKEND",
+        "redis" if "EVENTS_REDIS_URL" in os.environ or "CACHE_REDIS_URL" in os.environ else "none"
+    )
+    EVENTS_ALLOW_MEMORY = False
+
+
+CONFIGS = {
+    "development": DevelopmentConfig,
+    "production": ProductionConfig
+}
+
+
+def get_config():
+    """
+    The profile selected by APP_ENV, development by default
+    """
+    profile = os.environ.get("APP_ENV", "development")
+    if profile not in CONFIGS:
+        raise RuntimeError(f"Unknown APP_ENV: {profile}")
+    return CONFIGS[profile]
+
+
+def engine_options(config, url=None):
+    """
+    SQLALCHEMY_ENGINE_OPTIONS for url, the primary database of config
+    by default
+    """
+    options = {
+        "pool_pre_ping": True,
+        "pool_size": config["DB_POOL_SIZE"],
+        "max_overflow": config["DB_MAX_OVERFLOW"],
+    }
+    url = make_url(url or config["SQLALCHEMY_DATABASE_URI"])
+    if url.get_backend_name() == "sqlite":
+        if url.database in (None, "", ":memory:"):
+            return {}
+        # SQLAlchemy 1.4 does not pool file databases by default
+        options["poolclass"] = QueuePool
+        options["connect_args"] = {"check_same_thread": False}
+    else:
+        options["pool_recycle"] = config["DB_POOL_RECYCLE"]
+    return options
+
+
+def replica_binds(config):
+    """
+    SQLALCHEMY_BINDS entries "replica0", "replica1", ... for the
+    DATABASE_REPLICA_URLS of config
+    """
+    binds = {}
+    for i, url in enumerate(config["DATABASE_REPLICA_URLS"]):
+        binds[f"replica{i}"] = {"url": url, **engine_options(config, url)}
+    return binds
+
+
+def configure_sqlite(engine, config):
+    """
+    Apply SQLITE_PRAGMAS to every new connection of engine and, with
+    SQLITE_BEGIN_IMMEDIATE, open the transactions of write requests
+    with BEGIN IMMEDIATE. Does nothing for other databases
+    """
+    if engine.dialect.name != "sqlite":
+        return
+    pragmas = config["SQLITE_PRAGMAS"]
+    begin_immediate = config["SQLITE_BEGIN_IMMEDIATE"]
+
+    @event.listens_for(engine, "connect")
+    def on_connect(dbapi_connection, connection_record):
+        if begin_immediate:
+            # let SQLAlchemy emit BEGIN instead of the sqlite3 module
+            dbapi_connection.isolation_level = None
+        cursor = dbapi_connection.cursor()
+        for name, value in pragmas.items():
+            cursor.execute(f"PRAGMA {name}={value}")
+        cursor.close()
+
+    if begin_immediate:
+        @event.listens_for(engine, "begin")
+        def on_begin(connection):
+            # reads stay deferred, anything else (including background
+            # workers outside of a request) takes the write lock up front
+            if has_request_context() and request.method in ("GET", "HEAD"):
+                connection.exec_driver_sql("BEGIN")
+            else:
+                connection.exec_driver_sql("BEGIN IMMEDIATE")
@@ -1,6 +1,7 @@
 from flask_sqlalchemy import SQLAlchemy
+from routing import RoutingSession
+from sqlalchemy import select
 import base64
-import boto3
 import datetime
 import io
 from io import BytesIO
@@ -11,18 +12,25 @@ import random
 import re
 import string
 
-db = SQLAlchemy()
+db = SQLAlchemy(session_options={"class_": RoutingSession})
 
 inventory_category_association_table = db.Table(
   "association_category",
+  # keeps the order categories were assigned in
+  db.Column("id", db.Integer, primary_key = True),
   db.Column("inventory_id", db.Integer, db.ForeignKey("inventory.id")),
-  db.Column("category_id", db.Integer, db.ForeignKey("category.id"))
+  db.Column("category_id", db.Integer, db.ForeignKey("category.id")),
+  # one index per direction of the many to many
+  db.Index("ix_association_category_inventory_id", "inventory_id", "category_id"),
+  db.Index("ix_association_category_category_id", "category_id", "inventory_id")
 )
 
 inventory_order_menu_association_table = db.Table(
   "association_menu",
   db.Column("inventory_id", db.Integer, db.ForeignKey("inventory.id")),
-  db.Column("menu_id", db.Integer, db.ForeignKey("menu.id")) 
+  db.Column("menu_id", db.Integer, db.ForeignKey("menu.id")),
+  db.Index("ix_association_menu_inventory_id", "inventory_id", "menu_id"),
+  db.Index("ix_association_menu_menu_id", "menu_id", "inventory_id")
 )
 
 class Inventory (db.Model):
@@ -31,16 +39,21 @@ class Inventory (db.Model):
   """
 
   __tablename__ = "inventory"
+  # keyset pages of GET /inventories/ sorted by price or name
+  __table_args__ = (
+    db.Index("ix_inventory_price", "price", "id"),
+    db.Index("ix_inventory_name", "name", "id")
+  )
   id = db.Column(db.Integer, primary_key = True, autoincrement = True) 
   image = db.Column(db.String, nullable = False)
   name = db.Column(db.String, nullable = False)
   description = db.Column(db.String, nullable = False)
   price = db.Column(db.Float, nullable = False)
   # many to many (name + 's' represents for many to many field name), could be null
-  categories = db.relationship("Category", secondary = inventory_category_association_table, back_populates = "inventories") 
+  categories = db.relationship("Category", secondary = inventory_category_association_table, back_populates = "inventories", order_by = inventory_category_association_table.c.id) 
   menus = db.relationship("Menu", secondary = inventory_order_menu_association_table, back_populates = "inventories")
   # orderitems
-  order_items = db.relationship("Orderitem", cascade = "delete")
+  order_items = db.relationship("Orderitem", cascade = "delete", back_populates = "inventory")
 
   def __init__(self, **kwargs):
     """
@@ -64,22 +77,16 @@ class Inventory (db.Model):
       "price": self.price,
       "category": [c.simple_serialize() for c in self.categories],
       "menus": [m.simple_serialize() for m in self.menus],
-      "order_items": [oi.simple_serialize() for oi in self.order_items]
+      "order_items": [oi.serialize() for oi in self.order_items]
     }
   
   def serialize_for_render(self):
      """
      Serializes necessary info for front end to render
      """
-     try:
-        selectedNum = self.order_items[0].num_sel
-     except Exception as e:
-        selectedNum = 0
-
-     try:
-        category = self.categories[0].id
-     except Exception as e:
-        category = 0
+     # None when there are no orderitems or categories
+     selectedNum = self.selected_num or 0
+     category = self.first_category_id or 0
 
 
      return {
@@ -115,7 +122,7 @@ class Category(db.Model):
 
   __tablename__ = "category"
   id = db.Column(db.Integer, primary_key = True, autoincrement = True)
-  name = db.Column(db.String, nullable = False)
+  name = db.Column(db.String, nullable = False, index = True)
   description = db.Column(db.String, nullable = False)
   inventories = db.relationship("Inventory", secondary = inventory_category_association_table, back_populates ="categories")
 
@@ -159,8 +166,9 @@ class Menu(db.Model):
   instruction = db.Column(db.String, nullable = False)
   inventories = db.relationship("Inventory", secondary = inventory_order_menu_association_table, back_populates ="menus")
   #----------
-  # images = db.relationship("Asset", cascade = "delete")
-  image_id = db.Column(db.Integer, db.ForeignKey("assets.id"), nullable=False)
+  image_id = db.Column(db.Integer, db.ForeignKey("assets.id"), nullable=False, index=True)
+  # many to one, load it with the menu instead of querying in serialize
+  image = db.relationship("Asset")
 
 
   def __init__(self, **kwargs):
@@ -177,13 +185,11 @@ class Menu(db.Model):
     """
     serialize
     """
-    asset = Asset.query.filter_by(id = self.image_id).first()
-
     return{"id": self.id, 
            "name": self.name,
             "description": self.description, 
-           "inventories": [t.serialize() for t in self.inventories],
-           "image": asset.serialize()
+           "inventories": [t.serialize_for_category() for t in self.inventories],
+           "image": self.image.serialize()
            }
   
   
@@ -199,13 +205,14 @@ class Order(db.Model):
   """
 
   __tablename__ = "order"
+  __table_args__ = (db.Index("ix_order_valid_pick_up_by", "valid", "pick_up_by"),)
   id = db.Column(db.Integer, primary_key = True, autoincrement = True) 
   time_created = db.Column(db.DateTime)
   pick_up_by  = db.Column(db.DateTime)
   total_price = db.Column(db.Float, nullable = False)
   valid = db.Column(db.Boolean, nullable = False)
-  # one to many
-  order_items = db.relationship("Orderitem", cascade = "delete")
+  # one to many, in the order the lines were added to the cart
+  order_items = db.relationship("Orderitem", cascade = "delete", order_by = "Orderitem.id")
 
 
   
@@ -245,10 +252,18 @@ class Orderitem(db.Model):
   Orderitem model
   """
   __tablename__ = "orderitem"
+  # an inventory appears at most once per order, also the index for
+  # lookups by order_id alone. The lines of an order are read in id order
+  __table_args__ = (
+    db.Index("uq_orderitem_order_inventory", "order_id", "inventory_id", unique = True),
+    db.Index("ix_orderitem_order_id_id", "order_id", "id")
+  )
   id = db.Column(db.Integer, primary_key = True, autoincrement = True) 
   num_sel = db.Column(db.Integer,  nullable = False)
-  inventory_id = db.Column(db.Integer, db.ForeignKey("inventory.id"), nullable = False)
+  inventory_id = db.Column(db.Integer, db.ForeignKey("inventory.id"), nullable = False, index = True)
   order_id = db.Column(db.Integer, db.ForeignKey("order.id"), nullable = False)
+  # many to one, lets orders load all of their inventories in one query
+  inventory = db.relationship("Inventory", back_populates = "order_items")
 
   def __init__(self, **kwargs):
     """
@@ -273,7 +288,7 @@ class Orderitem(db.Model):
     """
     Serialize
     """
-    inventory = Inventory.query.filter_by(id = self.inventory_id).first()
+    inventory = self.inventory
 
     return{
 
@@ -282,13 +297,49 @@ class Orderitem(db.Model):
       "selectedNum":self.num_sel
     }
   
+
+# what Inventory.serialize_for_render shows of the orderitems and categories,
+# as correlated subqueries instead of loading every orderitem ever placed.
+# Deferred so that other inventory queries don't pay for them, lists load
+# them in the same SELECT with undefer_group("render")
+Inventory.selected_num = db.column_property(
+  select(Orderitem.num_sel)
+  .where(Orderitem.inventory_id == Inventory.id)
+  .order_by(Orderitem.id)
+  .limit(1)
+  .correlate_except(Orderitem)
+  .scalar_subquery(),
+  deferred = True,
+  group = "render"
+)
+Inventory.first_category_id = db.column_property(
+  select(inventory_category_association_table.c.category_id)
+  .where(inventory_category_association_table.c.inventory_id == Inventory.id)
+  # the category the categories relationship lists first
+  .order_by(inventory_category_association_table.c.id)
+  .limit(1)
+  .correlate_except(inventory_category_association_table)
+  .scalar_subquery(),
+  deferred = True,
+  group = "render"
+)
   
 
 EXTENSIONS = ["png","gif","jpg","jpeg"]
-BASE_DIR = os.getcwd()
 S3_BUCKET_NAME = os.environ.get("S3_BUCKET_NAME")
 S3_BASE_URL = f"https://{S3_BUCKET_NAME}.s3.us-east-1.amazonaws.com"
 
+def generate_salt():
+    """
+    Generate a random string for an image file name
+    """
+    return "".join(
+        random.SystemRandom().choice(
+            string.ascii_uppercase+ string.digits
+        )
+        for _ in range(16)
+    )
+
 class Asset(db.Model):
     """
     Asset Model
@@ -302,92 +353,125 @@ class Asset(db.Model):
     width = db.Column(db.Integer, nullable=False)
     height = db.Column(db.Integer, nullable=False)
     created_at = db.Column(db.DateTime, nullable = False)
+    # "pending" until the image is uploaded, then "ready" or "failed"
+    status = db.Column(db.String, nullable = False, default = "ready", server_default = "ready")
+    # resized copies of the image, generated at upload time
+    variants = db.relationship("AssetVariant", cascade = "delete")
 
     # menu_id = db.Column(db.Integer, db.ForeignKey("menu.id"), nullable = False)
 
     def __init__(self,**kwargs):
         """
-        Initializes an Asset object/entry
+        Initializes an Asset object/entry, either from a base64 image_data
+        or from the extension, width and height of a streamed upload
         """
-        self.create(kwargs.get("image_data"))
+        image_data = kwargs.get("image_data")
+        base_url = kwargs.get("base_url", S3_BASE_URL)
+        if image_data is not None:
+            self.create(image_data, base_url)
+            return
+
+        self.base_url = base_url
+        self.salt = generate_salt()
+        self.extension = kwargs.get("extension")
+        self.width = kwargs.get("width")
+        self.height = kwargs.get("height")
+        self.created_at = datetime.datetime.now()
+        self.status = "pending"
+
+    @property
+    def filename(self):
+        return f"{self.salt}.{self.extension}"
 
     def serialize(self):
         """
         Serializes and Asset object
         """
 
+        srcset = {}
+        for variant in self.variants:
+            srcset.setdefault(variant.extension, {})[f"{variant.width}w"] = f"{self.base_url}/{variant.filename}"
+
         return{
-            "url": f"{self.base_url}/{self.salt}.{self.extension}",
+            "url": f"{self.base_url}/{self.filename}",
+            "status": self.status,
+            "srcset": srcset,
             "created_at": str(self.created_at)
         }
 
-    def create(self, image_data):
+    def create(self, image_data, base_url):
         """
         Given an image in base64 form, it
         1. Rejects the image is the filetype is not supported file type
         2. Generates a random string for the image file name
-        3. Decodes the image and attempts to upload it to AWS
+        3. Decodes the image and reads its size from the image header
+        The decoded bytes are kept in self.data for the UploadQueue, the
+        asset stays pending until they are uploaded.
+        Raises ValueError if the image is not supported or can't be read
         """
-        try:
-            ext = guess_extension(guess_type(image_data)[0])[1:]
+        content_type = guess_type(image_data)[0]
+        ext = guess_extension(content_type)[1:] if content_type else None
 
-            #only accepts supported file types
-            if ext not in EXTENSIONS:
-                raise Exception(f"Unsupported file type: {ext}")
+        #only accepts supported file types
+        if ext not in EXTENSIONS:
+            raise ValueError(f"Unsupported file type: {ext}")
 
+        salt = generate_salt()
 
-            #generate random strong name for file
-            salt = "".join(
-                random.SystemRandom().choice(
-                    string.ascii_uppercase+ string.digits
-                )
-                for _ in range(16)
-            )
-
-            #decode the image and upload to aws
-            #remove header of base64 string
+        try:
+            #remove header of base64 string and decode the image,
+            #Image.open only parses the header to get the size
             img_str = re.sub("^data:image/.+;base64,", "", image_data)
             img_data = base64.b64decode(img_str)
             img = Image.open(BytesIO(img_data))
+        except (OSError, ValueError) as e:
+            raise ValueError(f"Error when creating image: {e}")
 
-            self.base_url = S3_BASE_URL
-            self.salt = salt
-            self.extension = ext
-            self.width = img.width
-            self.height = img.height
-            self.created_at = datetime.datetime.now()
+        self.base_url = base_url
+        self.salt = salt
+        self.extension = ext
+        self.width = img.width
+        self.height = img.height
+        self.created_at = datetime.datetime.now()
+        self.status = "pending"
 
-            img_filename = f"{self.salt}.{self.extension}"
-            self.upload(img, img_filename)
+        self.content_type = content_type
+        self.data = img_data
 
-        except Exception as e:
-            print(f"Error when creating image: {e}")
 
-    def upload(self, img, img_filename):
-        """
-        Attempt to upload the image to the specified S3 bucket
-        """
-        try:
-            # save image temporarily on server
-            img_temploc = f"{BASE_DIR}/{img_filename}"
-            img.save(img_temploc)
-            
-            # upload image to S3
-            s3_client = boto3.client("s3")
-            s3_client.upload_file(img_temploc, S3_BUCKET_NAME, img_filename)
-
-            # make s3 image url is public
-            s3_resource = boto3.resource("s3")
-            object_acl = s3_resource.ObjectAcl(S3_BUCKET_NAME, img_filename)
-            object_acl.put(ACL="public-read")
-
-            # removes image from server
-            os.remove(img_temploc)
-
-
-        except Exception as e:
-            print(f"Error when uploading image: {e}")
-            
+class AssetVariant(db.Model):
+    """
+    AssetVariant Model
+    A resized copy of an Asset image in one format
+    """
+    __tablename__ = "asset_variants"
+    id = db.Column(db.Integer, primary_key=True, autoincrement=True)
+    asset_id = db.Column(db.Integer, db.ForeignKey("assets.id"), nullable=False, index=True)
+    key = db.Column(db.String, nullable=False)
+    salt = db.Column(db.String, nullable=False)
+    extension = db.Column(db.String, nullable=False)
+    width = db.Column(db.Integer, nullable=False)
+    height = db.Column(db.Integer, nullable=False)
+
+    @property
+    def filename(self):
+        return f"{self.salt}_{self.key}.{self.extension}"
+
+
+class CatalogChange(db.Model):
+    """
+    CatalogChange Model
+    One upsert or delete of an inventory, category or menu. The id grows
+    with every change and is the token clients sync from, ids are
+    committed in order (see changes.lock_change_log)
+    """
+    __tablename__ = "catalog_change"
+    id = db.Column(db.Integer, primary_key=True, autoincrement=True)
+    entity = db.Column(db.String, nullable=False)
+    entity_id = db.Column(db.Integer, nullable=False)
+    op = db.Column(db.String, nullable=False)
+    changed_at = db.Column(db.DateTime, nullable=False, default=datetime.datetime.now)
+
 #-------------------------------------------------------------------------------
 
 
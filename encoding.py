@@ -0,0 +1,46 @@
+import json
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# separators between the items of an array and after an object key,
+# as written by the encoder in use
+if orjson is not None:
+    ITEM_SEPARATOR = ","
+    KEY_SEPARATOR = ":"
+else:
+    ITEM_SEPARATOR = ", "
+    KEY_SEPARATOR = ": "
+
+
+def dumps(data):
+    """
+    Encode data as a JSON string, with orjson when it is installed
+    """
+    if orjson is not None:
+        return orjson.dumps(data, option=orjson.OPT_NON_STR_KEYS).decode()
+    return json.dumps(data)
+
+
+def iter_list(key, items, encode=dumps, chunk_size=64 * 1024):
+    """
+    Encode {key: [items]} in chunks of about chunk_size characters,
+    exactly as dumps would write it as a whole, without holding the
+    list or the full string
+    """
+    parts = ["{" + dumps(key) + KEY_SEPARATOR + "["]
+    size = 0
+    separator = ""
+    for item in items:
+        part = separator + encode(item)
+        parts.append(part)
+        size += len(part)
+        separator = ITEM_SEPARATOR
+        if size >= chunk_size:
+            yield "".join(parts)
+            parts = []
+            size = 0
+    parts.append("]}")
+    yield "".join(parts)
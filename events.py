@@ -0,0 +1,209 @@
+import queue
+import threading
+import time
+
+from encoding import dumps
+
+try:
+    import redis
+except ImportError:
+    redis = None
+
+
+class TooManySubscribers(Exception):
+    pass
+
+
+def format_event(event_type, data):
+    """
+    Encode one event as a Server-Sent Events frame
+    """
+    return f"event: {event_type}\ndata: {dumps(data)}\n\n"
+
+
+class Subscription:
+    """
+    Frames published to any of channels, waiting to be sent to one client.
+    A client that falls max_queued frames behind is dropped rather than
+    buffered without bounds, it reconnects and catches up from
+    /catalog/changes/ or /orders/<id>/
+    """
+
+    def __init__(self, channels, max_queued=100):
+        self.channels = channels
+        self.frames = queue.Queue(max_queued)
+        self.overflowed = False
+        self.closed = False
+
+    def put(self, frame):
+        try:
+            self.frames.put_nowait(frame)
+        except queue.Full:
+            self.overflowed = True
+
+    def get(self, timeout):
+        """
+        The next frame, None when nothing was published for timeout seconds
+        """
+        try:
+            return self.frames.get(timeout=timeout)
+        except queue.Empty:
+            return None
+
+
+class RedisBroker:
+    """
+    Fans events out to every worker process through Redis pub/sub.
+    Every process listens on one connection, whatever the number of its
+    subscribers, and hands the frames to its own bus. An event is one
+    message carrying the list of its channels, so that every bus can
+    deliver it once to a client subscribed to several of them
+    """
+
+    def __init__(self, url, channel="anabels:events"):
+        if redis is None:
+            raise RuntimeError("EVENTS_BACKEND is redis but the redis package is not installed")
+        self.client = redis.Redis.from_url(url)
+        self.channel = channel
+        self.listener = None
+        self.lock = threading.Lock()
+
+    def publish(self, channels, frame):
+        # channel names hold no spaces or newlines
+        self.client.publish(self.channel, f"{' '.join(channels)}\n{frame}")
+
+    def listen(self, deliver):
+        """
+        Start the listener thread of this process, if it is not running yet
+        """
+        with self.lock:
+            if self.listener is None:
+                self.listener = threading.Thread(target=self.run, args=(deliver,), daemon=True)
+                self.listener.start()
+
+    def run(self, deliver):
+        while True:
+            try:
+                pubsub = self.client.pubsub(ignore_subscribe_messages=True)
+                pubsub.subscribe(self.channel)
+                for message in pubsub.listen():
+                    channels, frame = message["data"].decode().split("\n", 1)
+                    deliver(channels.split(" "), frame)
+            except redis.RedisError:
+                # events published while reconnecting are lost, clients
+                # catch up from the catalog change log
+                time.sleep(1)
+
+
+class EventBus:
+    """
+    Publish/subscribe of order and catalog events for the /events/ stream.
+    Events are encoded once when published, and every subscriber of the
+    channel gets the same frame. Subscribers only hold a bounded queue,
+    no thread or database connection of their own beyond the request
+    serving them
+    """
+
+    def __init__(self, app=None):
+        self.broker = None
+        self.enabled = True
+        self.subscribers = {}
+        self.count = 0
+        self.delivered = 0
+        self.dropped = 0
+        self.lock = threading.Lock()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        """
+        Configure the broker from EVENTS_BACKEND ("memory", "redis" or "none"),
+        EVENTS_REDIS_URL, EVENTS_MAX_SUBSCRIBERS, EVENTS_QUEUE_SIZE and
+        EVENTS_HEARTBEAT. EVENTS_ALLOW_MEMORY off refuses the memory
+        backend, for profiles running several workers
+        """
+        self.app = app
+        backend = app.config.get("EVENTS_BACKEND", "memory")
+        self.max_subscribers = int(app.config.get("EVENTS_MAX_SUBSCRIBERS", 10000))
+        self.max_queued = int(app.config.get("EVENTS_QUEUE_SIZE", 100))
+        self.heartbeat = float(app.config.get("EVENTS_HEARTBEAT", 15))
+        if backend == "memory" and not app.config.get("EVENTS_ALLOW_MEMORY", True):
+            raise RuntimeError("EVENTS_BACKEND memory only reaches the streams of its own process, use redis or none")
+        self.enabled = backend != "none"
+        if backend in ("memory", "none"):
+            self.broker = None
+        elif backend == "redis":
+            self.broker = RedisBroker(app.config.get("EVENTS_REDIS_URL", "redis://localhost:6379/0"))
+        else:
+            raise RuntimeError(f"Unknown EVENTS_BACKEND: {backend}")
+
+    def publish(self, channels, event_type, data):
+        """
+        Send an event to the subscribers of any of channels, once to
+        those subscribed to several of them, in every worker process
+        when there is a broker
+        """
+        if not self.enabled:
+            return
+        frame = format_event(event_type, data)
+        if self.broker is None:
+            self.deliver(channels, frame)
+            return
+        try:
+            self.broker.publish(channels, frame)
+        except Exception as e:
+            # the write it reports has been committed already
+            self.app.logger.warning(f"Could not publish {event_type} to {' '.join(channels)}: {e}")
+
+    def deliver(self, channels, frame):
+        subscribers = set()
+        with self.lock:
+            for channel in channels:
+                subscribers.update(self.subscribers.get(channel, ()))
+        for subscription in subscribers:
+            subscription.put(frame)
+        with self.lock:
+            self.delivered += len(subscribers)
+
+    def subscribe(self, channels):
+        with self.lock:
+            if self.count >= self.max_subscribers:
+                raise TooManySubscribers(f"More than {self.max_subscribers} event subscribers")
+            subscription = Subscription(channels, self.max_queued)
+            for channel in channels:
+                self.subscribers.setdefault(channel, set()).add(subscription)
+            self.count += 1
+        if self.broker is not None:
+            self.broker.listen(self.deliver)
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self.lock:
+            if subscription.closed:
+                return
+            subscription.closed = True
+            for channel in subscription.channels:
+                subscribers = self.subscribers.get(channel)
+                if subscribers is None:
+                    continue
+                subscribers.discard(subscription)
+                if not subscribers:
+                    del self.subscribers[channel]
+            self.count -= 1
+            if subscription.overflowed:
+                self.dropped += 1
+
+    def stream(self, subscription):
+        """
+        Frames of an event stream for subscription, with a comment line
+        every heartbeat seconds so that proxies keep idle connections open
+        """
+        # opens the stream at once and tells EventSource when to reconnect
+        yield f"retry: 3000\n: subscribed to {' '.join(subscription.channels)}\n\n"
+        while not subscription.overflowed:
+            frame = subscription.get(self.heartbeat)
+            yield frame if frame is not None else ": heartbeat\n\n"
+
+    def stats(self):
+        with self.lock:
+            return {"subscribers": self.count, "delivered": self.delivered, "dropped": self.dropped}
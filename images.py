@@ -0,0 +1,92 @@
+from io import BytesIO
+
+from PIL import Image, ImageFile
+
+# file extension and content type of each derivative format
+FORMATS = {
+    "webp": ("webp", "image/webp"),
+    "jpeg": ("jpg", "image/jpeg")
+}
+
+# file extension and content type of each accepted upload, by PIL format
+UPLOAD_FORMATS = {
+    "PNG": ("png", "image/png"),
+    "JPEG": ("jpg", "image/jpeg"),
+    "GIF": ("gif", "image/gif")
+}
+
+# the largest header read to find the type and size of an upload,
+# JPEG files can carry long EXIF blocks before their size
+MAX_HEADER_SIZE = 256 * 1024
+
+
+def sniff_image(stream, chunk_size=16 * 1024):
+    """
+    Read the start of an image from stream until its type and size are
+    known, without reading or decoding the rest of it.
+    Returns (format, width, height, header) where header holds the bytes
+    consumed from stream.
+    Raises ValueError if no image header is found in MAX_HEADER_SIZE bytes
+    """
+    parser = ImageFile.Parser()
+    header = bytearray()
+    while parser.image is None and len(header) < MAX_HEADER_SIZE:
+        chunk = stream.read(chunk_size)
+        if not chunk:
+            break
+        header += chunk
+        parser.feed(chunk)
+
+    if parser.image is None:
+        raise ValueError("cannot identify image file")
+    img = parser.image
+    return img.format, img.width, img.height, bytes(header)
+
+
+def parse_variants(spec):
+    """
+    Parse a variant spec such as "thumb:160,small:320" into
+    a list of (key, width) pairs
+    """
+    variants = []
+    for item in spec.split(","):
+        if not item.strip():
+            continue
+        key, width = item.split(":")
+        variants.append((key.strip(), int(width)))
+    return variants
+
+
+def render_variants(data, variants, formats):
+    """
+    Resize the image bytes data to every (key, width) in variants, in every
+    format of formats, keeping the aspect ratio and never upscaling.
+    Returns a list of (key, format, width, height, bytes).
+    Only depends on PIL so that it can run in a process pool
+    """
+    img = Image.open(BytesIO(data))
+    original_width, original_height = img.size
+    if not variants:
+        return []
+
+    # let JPEG decode at a reduced scale when that is enough for every variant
+    max_width = min(max(w for _, w in variants), original_width)
+    img.draft("RGB", (max_width, max(1, round(original_height * max_width / original_width))))
+    img.load()
+
+    rendered = []
+    for key, width in variants:
+        if width > original_width:
+            continue
+        height = max(1, round(original_height * width / original_width))
+        resized = img.resize((width, height), Image.LANCZOS)
+        for fmt in formats:
+            out = resized
+            if fmt == "jpeg" and out.mode != "RGB":
+                out = out.convert("RGB")
+            elif out.mode not in ("RGB", "RGBA"):
+                out = out.convert("RGBA")
+            buf = BytesIO()
+            out.save(buf, fmt.upper(), quality=80)
+            rendered.append((key, fmt, width, height, buf.getvalue()))
+    return rendered
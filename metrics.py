@@ -0,0 +1,357 @@
+import json
+import os
+import threading
+import time
+import uuid
+from collections import defaultdict
+from contextlib import contextmanager
+
+from flask import g, has_request_context, request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+# upper bounds of the latency histogram buckets, in seconds
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+# upper bounds of the queries per request histogram buckets
+QUERY_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 250)
+
+
+class Histogram:
+    """
+    Cumulative Prometheus style histogram with fixed buckets
+    """
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.count = 0
+        self.sum = 0
+
+    def observe(self, value):
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+        self.count += 1
+        self.sum += value
+
+    def add(self, counts, count, total):
+        self.counts = [a + b for a, b in zip(self.counts, counts)]
+        self.count += count
+        self.sum += total
+
+
+class RequestStats:
+    """
+    Counters of one request, kept outside of flask.g so that the
+    statements of a streamed response body are still counted once
+    the response headers have been sent
+    """
+
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.queries = 0
+        self.sql_time = 0.0
+        self.serialize_time = 0.0
+
+
+def current_stats():
+    if has_request_context():
+        return g.get("request_stats")
+    return None
+
+
+def escape(value):
+    return str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+
+def labels(**kwargs):
+    return ",".join(f'{k}="{escape(v)}"' for k, v in kwargs.items())
+
+
+def is_running(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+HISTOGRAMS = {"latency": LATENCY_BUCKETS, "queries": QUERY_BUCKETS}
+COUNTERS = ("sql_time", "serialize_time", "responses", "over_budget")
+
+
+def merge_snapshots(snapshots):
+    """
+    Sum the snapshots of several processes. Histograms and counters of
+    exited processes still count, so that totals never go down; the
+    gauges of add_collector only count for running processes
+    """
+    totals = {name: {} for name in HISTOGRAMS}
+    totals.update({name: defaultdict(int) for name in COUNTERS})
+    totals["gauges"] = defaultdict(lambda: defaultdict(int))
+    for snapshot in snapshots:
+        for name, buckets in HISTOGRAMS.items():
+            for *key, counts, count, total in snapshot[name]:
+                totals[name].setdefault(tuple(key), Histogram(buckets)).add(counts, count, total)
+        for name in COUNTERS:
+            for *key, value in snapshot[name]:
+                totals[name][tuple(key)] += value
+        if is_running(snapshot["pid"]):
+            for name, values in snapshot["gauges"].items():
+                for kind, value in values.items():
+                    totals["gauges"][name][kind] += value
+    return totals
+
+
+class Metrics:
+    """
+    Per endpoint request metrics of this process: latency, number of SQL
+    queries, time spent in SQL and time spent serializing responses.
+    SQL statements are counted by cursor events on every engine and
+    attributed to the request running them, statements outside of a
+    request (upload workers, migrations) are not counted.
+    Streamed responses are recorded when they are closed, so that their
+    body is included.
+    Requests running more than QUERY_BUDGET queries are logged, counted
+    and get an X-Query-Budget-Exceeded header. Every response carries
+    its X-Query-Count, for streamed responses the statements run before
+    the body is sent.
+    With METRICS_DIR set, every worker process writes a snapshot of its
+    metrics there every METRICS_WRITE_INTERVAL seconds and render() sums
+    the snapshots of all of them, so that any worker answering /metrics
+    reports the whole server
+    """
+
+    def __init__(self, app=None):
+        self.lock = threading.Lock()
+        self.latency = defaultdict(lambda: Histogram(LATENCY_BUCKETS))
+        self.queries = defaultdict(lambda: Histogram(QUERY_BUCKETS))
+        self.sql_time = defaultdict(float)
+        self.serialize_time = defaultdict(float)
+        self.responses = defaultdict(int)
+        self.over_budget = defaultdict(int)
+        self.query_budget = 0
+        self.collectors = []
+        self.directory = None
+        self.write_interval = 1.0
+        self.writer_pid = None
+        self.snapshot_path = None
+        self.app = None
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.app = app
+        self.query_budget = int(app.config.get("QUERY_BUDGET", 0))
+        self.directory = app.config.get("METRICS_DIR")
+        self.write_interval = float(app.config.get("METRICS_WRITE_INTERVAL", 1))
+        if self.directory:
+            os.makedirs(self.directory, exist_ok=True)
+        app.before_request(self.start_request)
+        app.after_request(self.finish_request)
+        event.listen(Engine, "before_cursor_execute", self.before_cursor_execute)
+        event.listen(Engine, "after_cursor_execute", self.after_cursor_execute)
+
+    def add_collector(self, name, help, fn):
+        """
+        Export the numbers returned by fn, a dict of counter values
+        keyed by the value of the "kind" label, as gauge name
+        """
+        self.collectors.append((name, help, fn))
+
+    # -- request hooks
+
+    def start_request(self):
+        g.request_stats = RequestStats()
+        if self.directory:
+            self.start_writer()
+
+    def finish_request(self, response):
+        stats = g.get("request_stats")
+        if stats is None:
+            return response
+        endpoint = request.endpoint or "unmatched"
+        method = request.method
+        path = request.path
+
+        response.headers["X-Query-Count"] = str(stats.queries)
+        if self.is_over_budget(stats):
+            response.headers["X-Query-Budget-Exceeded"] = f"{stats.queries}/{self.query_budget}"
+        if response.is_streamed:
+            # the body has not been generated yet
+            response.call_on_close(lambda: self.record(endpoint, method, path, response.status_code, stats))
+        else:
+            self.record(endpoint, method, path, response.status_code, stats)
+        return response
+
+    def is_over_budget(self, stats):
+        return self.query_budget > 0 and stats.queries > self.query_budget
+
+    def record(self, endpoint, method, path, status, stats):
+        elapsed = time.perf_counter() - stats.start
+        over_budget = self.is_over_budget(stats)
+        if over_budget:
+            self.app.logger.warning(
+                "%s %s ran %d queries, over the budget of %d",
+                method, path, stats.queries, self.query_budget
+            )
+
+        with self.lock:
+            key = (endpoint, method)
+            self.latency[key].observe(elapsed)
+            self.queries[key].observe(stats.queries)
+            self.sql_time[key] += stats.sql_time
+            self.serialize_time[key] += stats.serialize_time
+            self.responses[(endpoint, method, status)] += 1
+            if over_budget:
+                self.over_budget[key] += 1
+
+    @contextmanager
+    def serializing(self):
+        """
+        Add the time spent in the block to the serialization time of the
+        current request
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            stats = current_stats()
+            if stats is not None:
+                stats.serialize_time += time.perf_counter() - start
+
+    # -- engine hooks
+
+    def before_cursor_execute(self, conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault("query_start", []).append(time.perf_counter())
+
+    def after_cursor_execute(self, conn, cursor, statement, parameters, context, executemany):
+        starts = conn.info.get("query_start")
+        if not starts:
+            return
+        start = starts.pop()
+        stats = current_stats()
+        if stats is not None:
+            stats.queries += 1
+            stats.sql_time += time.perf_counter() - start
+
+    # -- export
+
+    def snapshot(self):
+        """
+        The metrics of this process as plain lists, for merge_snapshots
+        """
+        with self.lock:
+            snapshot = {
+                name: [[*key, h.counts, h.count, h.sum] for key, h in getattr(self, name).items()]
+                for name in HISTOGRAMS
+            }
+            snapshot.update({
+                name: [[*key, value] for key, value in getattr(self, name).items()]
+                for name in COUNTERS
+            })
+        snapshot["gauges"] = {name: fn() for name, help, fn in self.collectors}
+        snapshot["pid"] = os.getpid()
+        return snapshot
+
+    def start_writer(self):
+        """
+        Start the snapshot writer of this process, once per process as
+        gunicorn --preload forks the workers after the app is created
+        """
+        pid = os.getpid()
+        if self.writer_pid == pid:
+            return
+        with self.lock:
+            if self.writer_pid == pid:
+                return
+            self.writer_pid = pid
+            # a new file per process, the pid of an exited worker can be reused
+            self.snapshot_path = os.path.join(self.directory, f"{pid}-{uuid.uuid4().hex}.json")
+        threading.Thread(target=self.run_writer, daemon=True).start()
+
+    def run_writer(self):
+        while True:
+            try:
+                self.write_snapshot()
+            except Exception:
+                self.app.logger.exception("Error when writing the metrics snapshot")
+            time.sleep(self.write_interval)
+
+    def write_snapshot(self):
+        # replaced at once, readers never see half a file
+        temporary = f"{self.snapshot_path}.tmp"
+        with open(temporary, "w") as f:
+            json.dump(self.snapshot(), f)
+        os.replace(temporary, self.snapshot_path)
+
+    def snapshots(self):
+        """
+        The snapshot of this process, up to date, and the last ones
+        written by the other processes sharing METRICS_DIR
+        """
+        snapshots = [self.snapshot()]
+        if not self.directory:
+            return snapshots
+        for name in os.listdir(self.directory):
+            path = os.path.join(self.directory, name)
+            if not name.endswith(".json") or path == self.snapshot_path:
+                continue
+            try:
+                with open(path) as f:
+                    snapshots.append(json.load(f))
+            except (OSError, ValueError):
+                # removed or being replaced
+                continue
+        return snapshots
+
+    def render(self):
+        """
+        All metrics in the Prometheus text exposition format
+        """
+        totals = merge_snapshots(self.snapshots())
+        lines = []
+        lines.append("# HELP http_request_duration_seconds Request latency by endpoint")
+        lines.append("# TYPE http_request_duration_seconds histogram")
+        self.render_histograms(lines, "http_request_duration_seconds", totals["latency"])
+
+        lines.append("# HELP db_queries_per_request SQL statements run by each request")
+        lines.append("# TYPE db_queries_per_request histogram")
+        self.render_histograms(lines, "db_queries_per_request", totals["queries"])
+
+        lines.append("# HELP db_query_duration_seconds_total Time spent running SQL statements")
+        lines.append("# TYPE db_query_duration_seconds_total counter")
+        for (endpoint, method), value in sorted(totals["sql_time"].items()):
+            lines.append(f"db_query_duration_seconds_total{{{labels(endpoint=endpoint, method=method)}}} {value}")
+
+        lines.append("# HELP serialization_duration_seconds_total Time spent encoding response bodies to JSON")
+        lines.append("# TYPE serialization_duration_seconds_total counter")
+        for (endpoint, method), value in sorted(totals["serialize_time"].items()):
+            lines.append(f"serialization_duration_seconds_total{{{labels(endpoint=endpoint, method=method)}}} {value}")
+
+        lines.append("# HELP http_responses_total Responses by endpoint and status code")
+        lines.append("# TYPE http_responses_total counter")
+        for (endpoint, method, status), value in sorted(totals["responses"].items()):
+            lines.append(f"http_responses_total{{{labels(endpoint=endpoint, method=method, status=status)}}} {value}")
+
+        lines.append("# HELP query_budget_exceeded_total Requests running more than QUERY_BUDGET queries")
+        lines.append("# TYPE query_budget_exceeded_total counter")
+        for (endpoint, method), value in sorted(totals["over_budget"].items()):
+            lines.append(f"query_budget_exceeded_total{{{labels(endpoint=endpoint, method=method)}}} {value}")
+
+        for name, help, fn in self.collectors:
+            lines.append(f"# HELP {name} {help}")
+            lines.append(f"# TYPE {name} gauge")
+            for kind, value in sorted(totals["gauges"][name].items()):
+                lines.append(f"{name}{{{labels(kind=kind)}}} {value}")
+        return "\n".join(lines) + "\n"
+
+    def render_histograms(self, lines, name, histograms):
+        for (endpoint, method), histogram in sorted(histograms.items()):
+            for bound, count in zip(histogram.buckets, histogram.counts):
+                lines.append(f"{name}_bucket{{{labels(endpoint=endpoint, method=method, le=bound)}}} {count}")
+            lines.append(f"{name}_bucket{{{labels(endpoint=endpoint, method=method, le='+Inf')}}} {histogram.count}")
+            lines.append(f"{name}_sum{{{labels(endpoint=endpoint, method=method)}}} {histogram.sum}")
+            lines.append(f"{name}_count{{{labels(endpoint=endpoint, method=method)}}} {histogram.count}")
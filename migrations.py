@@ -0,0 +1,178 @@
+import datetime
+
+from sqlalchemy import Column, DateTime, Integer, MetaData, String, Table, func, inspect, select, text
+
+from db import db
+from db import CatalogChange
+from search import create_search_index
+
+# db.create_all() only creates missing tables, existing databases are
+# brought up to date by the numbered migrations below. Every migration
+# checks the current schema first, so on a database freshly created by
+# create_all() they only record their version
+schema_metadata = MetaData()
+schema_version_table = Table(
+    "schema_version",
+    schema_metadata,
+    Column("version", Integer, primary_key=True),
+    Column("description", String, nullable=False),
+    Column("applied_at", DateTime, nullable=False)
+)
+
+MIGRATIONS = []
+
+
+def migration(version, description):
+    """
+    Register a function taking a connection as migration number version
+    """
+    def decorator(fn):
+        MIGRATIONS.append((version, description, fn))
+        MIGRATIONS.sort(key=lambda m: m[0])
+        return fn
+    return decorator
+
+
+def has_column(connection, table, column):
+    return column in [c["name"] for c in inspect(connection).get_columns(table)]
+
+
+def create_index(connection, name):
+    """
+    Create the index called name as it is declared in db.py, if missing
+    """
+    for table in db.metadata.tables.values():
+        for index in table.indexes:
+            if index.name == name:
+                index.create(connection, checkfirst=True)
+                return
+    raise KeyError(f"No index named {name} in db.py")
+
+
+@migration(1, "Add assets.status")
+def add_asset_status(connection):
+    if not has_column(connection, "assets", "status"):
+        connection.execute(text("ALTER TABLE assets ADD COLUMN status VARCHAR NOT NULL DEFAULT 'ready'"))
+
+
+@migration(2, "Merge duplicate orderitems of the same inventory in an order")
+def merge_duplicate_orderitems(connection):
+    connection.execute(text("""
+        UPDATE orderitem SET num_sel = (
+            SELECT SUM(o.num_sel) FROM orderitem o
+            WHERE o.order_id = orderitem.order_id AND o.inventory_id = orderitem.inventory_id
+        )
+        WHERE id IN (
+            SELECT MIN(id) FROM orderitem GROUP BY order_id, inventory_id HAVING COUNT(*) > 1
+        )
+    """))
+    connection.execute(text("""
+        DELETE FROM orderitem WHERE id NOT IN (
+            SELECT MIN(id) FROM orderitem GROUP BY order_id, inventory_id
+        )
+    """))
+
+
+@migration(3, "Add lookup indexes and the orderitem (order_id, inventory_id) unique index")
+def add_lookup_indexes(connection):
+    for name in [
+        "uq_orderitem_order_inventory",
+        "ix_orderitem_inventory_id",
+        "ix_category_name",
+        "ix_association_category_inventory_id",
+        "ix_association_category_category_id",
+        "ix_association_menu_inventory_id",
+        "ix_association_menu_menu_id",
+        "ix_order_valid_pick_up_by",
+        "ix_menu_image_id",
+        "ix_asset_variants_asset_id"
+    ]:
+        create_index(connection, name)
+
+
+@migration(4, "Add the inventory full-text search index")
+def add_inventory_search(connection):
+    create_search_index(connection)
+
+
+@migration(5, "Add the inventory price and name indexes")
+def add_inventory_sort_indexes(connection):
+    for name in ["ix_inventory_price", "ix_inventory_name"]:
+        create_index(connection, name)
+
+
+@migration(6, "Add the catalog change log, starting with every existing catalog row")
+def add_catalog_changes(connection):
+    CatalogChange.__table__.create(connection, checkfirst=True)
+    if connection.execute(select(func.count()).select_from(CatalogChange.__table__)).scalar():
+        return
+    for entity, table in [("inventory", "inventory"), ("category", "category"), ("menu", "menu")]:
+        connection.execute(text(f"""
+            INSERT INTO catalog_change (entity, entity_id, op, changed_at)
+            SELECT :entity, id, 'upsert', :now FROM {table} ORDER BY id
+        """), {"entity": entity, "now": datetime.datetime.now()})
+
+
+@migration(7, "Add association_category.id, the order categories were assigned in")
+def add_association_category_id(connection):
+    if has_column(connection, "association_category", "id"):
+        return
+    if connection.dialect.name == "postgresql":
+        # numbered in the order the rows are stored, the closest to the
+        # order they were inserted in that is left
+        connection.exec_driver_sql("ALTER TABLE association_category ADD COLUMN id SERIAL PRIMARY KEY")
+        return
+
+    # SQLite can't add a primary key, copy the rows in rowid order into a
+    # new table. The search triggers name the table, they are dropped
+    # first and recreated with the index afterwards
+    for trigger in ["inventory_search_category_insert", "inventory_search_category_delete",
+                    "inventory_search_category_rename"]:
+        connection.exec_driver_sql(f"DROP TRIGGER IF EXISTS {trigger}")
+    connection.exec_driver_sql("""
+        CREATE TABLE association_category_new (
+            id INTEGER NOT NULL PRIMARY KEY,
+            inventory_id INTEGER REFERENCES inventory (id),
+            category_id INTEGER REFERENCES category (id)
+        )
+    """)
+    connection.exec_driver_sql("""
+        INSERT INTO association_category_new (inventory_id, category_id)
+        SELECT inventory_id, category_id FROM association_category ORDER BY rowid
+    """)
+    connection.exec_driver_sql("DROP TABLE association_category")
+    connection.exec_driver_sql("ALTER TABLE association_category_new RENAME TO association_category")
+    for name in ["ix_association_category_inventory_id", "ix_association_category_category_id"]:
+        create_index(connection, name)
+    create_search_index(connection)
+
+
+@migration(8, "Add the orderitem (order_id, id) index, the order cart lines are read in")
+def add_orderitem_order_index(connection):
+    create_index(connection, "ix_orderitem_order_id_id")
+
+
+def current_version(connection):
+    versions = connection.execute(select(schema_version_table.c.version)).scalars().all()
+    return max(versions, default=0)
+
+
+def upgrade(engine):
+    """
+    Apply every migration newer than the version recorded in the database,
+    each one in its own transaction. Returns the versions applied
+    """
+    schema_metadata.create_all(engine)
+    applied = []
+    for version, description, fn in MIGRATIONS:
+        with engine.begin() as connection:
+            if version <= current_version(connection):
+                continue
+            fn(connection)
+            connection.execute(schema_version_table.insert().values(
+                version=version,
+                description=description,
+                applied_at=datetime.datetime.now()
+            ))
+        applied.append(version)
+    return applied
@@ -0,0 +1,225 @@
+import hmac
+import importlib
+import os
+import re
+import sys
+import threading
+import time
+from collections import Counter
+from urllib.parse import parse_qs
+
+try:
+    from gevent import monkey
+except ImportError:
+    monkey = None
+
+# modules whose frames count as application code, anything else that is
+# not SQLAlchemy or serialization is Flask/Werkzeug overhead
+APP_MODULES = {
+    "__main__", "app", "db", "cache", "changes", "config", "encoding", "events", "images",
+    "metrics", "migrations", "routing", "search", "storage"
+}
+# modules encoding JSON; orjson runs no Python code, its time shows in encoding.
+# Serialization is encoding response bodies, the time metrics.serializing()
+# measures around encoding.dumps, so profiles and /metrics agree; building
+# the dicts (serialize_* methods) is application code
+SERIALIZATION_MODULES = {"encoding", "orjson"}
+CATEGORIES = ("sqlalchemy", "serialization", "app", "flask")
+
+
+def frame_name(frame):
+    return f"{frame.f_globals.get('__name__', '?')}:{frame.f_code.co_name}"
+
+
+def categorize(frames):
+    """
+    Category of a stack given from the innermost frame outwards: the
+    closest SQLAlchemy or serialization frame (the json encoder and
+    encoding.py) wins, then application code, then Flask
+    """
+    in_app = False
+    for frame in frames:
+        module = frame.f_globals.get("__name__", "")
+        if module == "sqlalchemy" or module.startswith("sqlalchemy."):
+            return "sqlalchemy"
+        if module == "json" or module.startswith("json.") or module in SERIALIZATION_MODULES:
+            return "serialization"
+        if module in APP_MODULES:
+            in_app = True
+    return "app" if in_app else "flask"
+
+
+def unpatched(module, name):
+    """
+    module.name as the standard library defines it, also once gevent
+    patched it (the production server): get_ident then returns greenlet
+    ids and threads are greenlets, which sys._current_frames doesn't know
+    and which can't interrupt a request busy on the CPU
+    """
+    if monkey is not None:
+        return monkey.get_original(module, name)
+    return getattr(importlib.import_module(module), name)
+
+
+class Sampler:
+    """
+    Samples the stack of the OS thread thread_id every interval seconds
+    from a thread of its own until stopped, counting collapsed stacks
+    prefixed by their category. Only stacks running inside root_frame
+    (the profiled request) are counted, without the frames of the server
+    around it; greenlets of other requests sharing the thread are skipped
+    """
+
+    def __init__(self, thread_id, interval, root_frame):
+        self.thread_id = thread_id
+        self.interval = interval
+        self.root_frame = root_frame
+        self.stacks = Counter()
+        self.stopped = False
+        self.finished = unpatched("_thread", "allocate_lock")()
+
+    def start(self):
+        self.finished.acquire()
+        unpatched("_thread", "start_new_thread")(self.run, ())
+
+    def run(self):
+        sleep = unpatched("time", "sleep")
+        try:
+            while not self.stopped:
+                sleep(self.interval)
+                self.sample()
+        finally:
+            self.finished.release()
+
+    def sample(self):
+        frame = sys._current_frames().get(self.thread_id)
+        frames = []
+        while frame is not None and frame is not self.root_frame:
+            frames.append(frame)
+            frame = frame.f_back
+        if frame is None:
+            return
+        frames.append(frame)
+        stack = ";".join(frame_name(f) for f in reversed(frames))
+        self.stacks[f"{categorize(frames)};{stack}"] += 1
+
+    def stop(self):
+        self.stopped = True
+        # waits at most one interval, blocking the worker when it runs greenlets
+        self.finished.acquire()
+        self.finished.release()
+
+
+class RequestProfiler:
+    """
+    WSGI middleware profiling single requests on demand. A request is
+    profiled when it carries PROFILE_TOKEN in an X-Profile header or a
+    ?profile= argument; the whole request, including reading the response
+    body, is then sampled every PROFILE_INTERVAL milliseconds.
+
+    The collapsed stacks, one "category;frame;frame count" line per stack
+    ready for flamegraph.pl or speedscope, are saved under PROFILE_DIR and
+    the response gets X-Profile-File and an X-Profile-Breakdown of the
+    samples by category (sqlalchemy, serialization, app, flask). With
+    X-Profile-Output: inline (or ?profile_output=inline) the collapsed
+    stacks replace the response body.
+
+    Without PROFILE_TOKEN the middleware is not installed at all
+    """
+
+    def __init__(self, app=None):
+        self.wsgi_app = None
+        self.token = None
+        self.directory = None
+        self.interval = 0.001
+        self.lock = threading.Lock()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.token = app.config.get("PROFILE_TOKEN")
+        if not self.token:
+            return
+        self.directory = app.config.get("PROFILE_DIR") or os.path.join(app.instance_path, "profiles")
+        self.interval = float(app.config.get("PROFILE_INTERVAL", 1)) / 1000
+        os.makedirs(self.directory, exist_ok=True)
+        self.wsgi_app = app.wsgi_app
+        app.wsgi_app = self
+
+    def requested(self, environ):
+        """
+        Whether the request asks to be profiled, and the output it wants
+        """
+        args = parse_qs(environ.get("QUERY_STRING", ""))
+        token = environ.get("HTTP_X_PROFILE") or args.get("profile", [""])[0]
+        if not token or not hmac.compare_digest(token.encode(), self.token.encode()):
+            return False, False
+        output = environ.get("HTTP_X_PROFILE_OUTPUT") or args.get("profile_output", [""])[0]
+        return True, output == "inline"
+
+    def __call__(self, environ, start_response):
+        profiled, inline = self.requested(environ)
+        if not profiled:
+            return self.wsgi_app(environ, start_response)
+
+        response = {}
+        body = []
+
+        def capture(status, headers, exc_info=None):
+            response["status"] = status
+            response["headers"] = headers
+            return body.append
+
+        # one profiled request at a time, the switch interval is process wide
+        with self.lock:
+            switch_interval = sys.getswitchinterval()
+            # let the sampler take the GIL as often as it samples
+            sys.setswitchinterval(min(switch_interval, self.interval))
+            sampler = Sampler(unpatched("_thread", "get_ident")(), self.interval, sys._getframe())
+            start = time.perf_counter()
+            sampler.start()
+            try:
+                app_iter = self.wsgi_app(environ, capture)
+                try:
+                    for chunk in app_iter:
+                        body.append(chunk)
+                finally:
+                    if hasattr(app_iter, "close"):
+                        app_iter.close()
+            finally:
+                sampler.stop()
+                sys.setswitchinterval(switch_interval)
+            elapsed = time.perf_counter() - start
+
+        collapsed = "".join(f"{stack} {count}\n" for stack, count in sampler.stacks.most_common())
+        path = self.save(environ, collapsed)
+
+        total = sum(sampler.stacks.values())
+        by_category = Counter()
+        for stack, count in sampler.stacks.items():
+            by_category[stack.split(";", 1)[0]] += count
+        breakdown = ", ".join(
+            f"{c}={100 * by_category[c] / total:.1f}%" if total else f"{c}=0.0%" for c in CATEGORIES
+        )
+
+        headers = [(k, v) for k, v in response["headers"] if k.lower() != "content-length" or not inline]
+        headers += [
+            ("X-Profile-File", os.path.basename(path)),
+            ("X-Profile-Samples", str(total)),
+            ("X-Profile-Duration", f"{elapsed * 1000:.1f}ms"),
+            ("X-Profile-Breakdown", breakdown)
+        ]
+        if inline:
+            body = [collapsed.encode()]
+            headers = [(k, v) for k, v in headers if k.lower() != "content-type"]
+            headers += [("Content-Type", "text/plain; charset=utf-8"), ("Content-Length", str(len(body[0])))]
+        start_response(response["status"], headers)
+        return body
+
+    def save(self, environ, collapsed):
+        route = re.sub(r"[^A-Za-z0-9]+", "_", environ.get("PATH_INFO", "")).strip("_") or "root"
+        name = f"{time.strftime('%Y%m%d-%H%M%S')}-{time.time_ns() % 10**9:09d}-{environ.get('REQUEST_METHOD', 'GET')}-{route}.folded"
+        path = os.path.join(self.directory, name)
+        with open(path, "w") as f:
+            f.write(collapsed)
+        return path
@@ -0,0 +1,76 @@
+import random
+import time
+
+from flask import g, has_app_context, request
+from flask_sqlalchemy.session import Session
+
+# cookie holding the time until which a client reads from the primary
+READ_YOUR_WRITES_COOKIE = "rw_until"
+
+
+def replica_bind_keys(config):
+    """
+    The SQLALCHEMY_BINDS keys of the read replicas
+    """
+    return sorted(k for k in config.get("SQLALCHEMY_BINDS", {}) if k.startswith("replica"))
+
+
+def reading_from_replica():
+    """
+    Whether the current request reads from a replica, which may not have
+    caught up with the latest writes to the primary yet
+    """
+    return has_app_context() and g.get("db_replica") is not None
+
+
+class RoutingSession(Session):
+    """
+    Session sending the queries of read-only requests to the replica chosen
+    for the request by ReplicaRouter. Flushes, and everything outside such
+    a request, keep using the primary
+    """
+
+    def get_bind(self, mapper=None, clause=None, bind=None, **kwargs):
+        if bind is None and not self._flushing and has_app_context():
+            replica = g.get("db_replica")
+            if replica is not None:
+                return self._db.engines[replica]
+        return super().get_bind(mapper=mapper, clause=clause, bind=bind, **kwargs)
+
+
+class ReplicaRouter:
+    """
+    Picks a read replica for every GET/HEAD request when replicas are
+    configured. A client that made a successful write gets a cookie that
+    keeps its reads on the primary for READ_YOUR_WRITES_SECONDS, so it sees
+    its own changes even when the replicas lag behind
+    """
+
+    def __init__(self, app=None):
+        self.replicas = []
+        self.window = 0
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.replicas = replica_bind_keys(app.config)
+        self.window = int(app.config.get("READ_YOUR_WRITES_SECONDS", 5))
+        if self.replicas:
+            app.before_request(self.choose_bind)
+            app.after_request(self.remember_write)
+
+    def choose_bind(self):
+        if request.method not in ("GET", "HEAD"):
+            return
+        try:
+            recent_write = float(request.cookies.get(READ_YOUR_WRITES_COOKIE, 0)) > time.time()
+        except ValueError:
+            recent_write = False
+        if not recent_write:
+            g.db_replica = random.choice(self.replicas)
+
+    def remember_write(self, response):
+        if request.method not in ("GET", "HEAD") and response.status_code < 400:
+            until = time.time() + self.window
+            response.set_cookie(READ_YOUR_WRITES_COOKIE, f"{until:.3f}", max_age=self.window, httponly=True)
+        return response
@@ -0,0 +1,200 @@
+import re
+
+from sqlalchemy import text
+
+# full-text index over the name, description and category names of every
+# inventory. SQLite keeps it in an FTS5 table and Postgres in a tsvector
+# table with a GIN index; triggers on inventory, category and
+# association_category keep it in sync, so writes through the ORM and
+# raw SQL alike are indexed
+
+# refreshes the category names indexed for the inventories matched by where
+SQLITE_REFRESH_CATEGORIES = """
+    UPDATE inventory_search SET categories = coalesce((
+        SELECT group_concat(category.name, ' ') FROM category
+        JOIN association_category ON association_category.category_id = category.id
+        WHERE association_category.inventory_id = inventory_search.rowid
+    ), '')
+    WHERE {where};
+"""
+
+SQLITE_SCHEMA = [
+    """
+    CREATE VIRTUAL TABLE IF NOT EXISTS inventory_search USING fts5(
+        name, description, categories,
+        tokenize = 'porter unicode61 remove_diacritics 2'
+    )
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS inventory_search_insert AFTER INSERT ON inventory BEGIN
+        INSERT INTO inventory_search (rowid, name, description, categories)
+        VALUES (new.id, new.name, new.description, '');
+    END
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS inventory_search_update AFTER UPDATE OF name, description ON inventory BEGIN
+        UPDATE inventory_search SET name = new.name, description = new.description WHERE rowid = new.id;
+    END
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS inventory_search_delete AFTER DELETE ON inventory BEGIN
+        DELETE FROM inventory_search WHERE rowid = old.id;
+    END
+    """,
+    "CREATE TRIGGER IF NOT EXISTS inventory_search_category_insert AFTER INSERT ON association_category BEGIN"
+    + SQLITE_REFRESH_CATEGORIES.format(where="rowid = new.inventory_id") + "END",
+    "CREATE TRIGGER IF NOT EXISTS inventory_search_category_delete AFTER DELETE ON association_category BEGIN"
+    + SQLITE_REFRESH_CATEGORIES.format(where="rowid = old.inventory_id") + "END",
+    "CREATE TRIGGER IF NOT EXISTS inventory_search_category_rename AFTER UPDATE OF name ON category BEGIN"
+    + SQLITE_REFRESH_CATEGORIES.format(
+        where="rowid IN (SELECT inventory_id FROM association_category WHERE category_id = new.id)"
+    ) + "END",
+]
+
+SQLITE_BACKFILL = [
+    "DELETE FROM inventory_search",
+    """
+    INSERT INTO inventory_search (rowid, name, description, categories)
+    SELECT inventory.id, inventory.name, inventory.description, coalesce((
+        SELECT group_concat(category.name, ' ') FROM category
+        JOIN association_category ON association_category.category_id = category.id
+        WHERE association_category.inventory_id = inventory.id
+    ), '')
+    FROM inventory
+    """,
+]
+
+# names weigh more than category names, which weigh more than descriptions
+SQLITE_SEARCH = """
+    SELECT rowid FROM inventory_search
+    WHERE inventory_search MATCH :query
+    ORDER BY bm25(inventory_search, 10.0, 2.0, 5.0)
+    LIMIT :limit
+"""
+
+POSTGRES_SCHEMA = [
+    """
+    CREATE TABLE IF NOT EXISTS inventory_search (
+        inventory_id INTEGER PRIMARY KEY REFERENCES inventory (id) ON DELETE CASCADE,
+        document TSVECTOR NOT NULL
+    )
+    """,
+    "CREATE INDEX IF NOT EXISTS ix_inventory_search_document ON inventory_search USING GIN (document)",
+    """
+    CREATE OR REPLACE FUNCTION inventory_search_refresh(target INTEGER) RETURNS VOID AS $$
+        INSERT INTO inventory_search (inventory_id, document)
+        SELECT inventory.id,
+            setweight(to_tsvector('english', coalesce(inventory.name, '')), 'A') ||
+            setweight(to_tsvector('english', coalesce((
+                SELECT string_agg(category.name, ' ') FROM category
+                JOIN association_category ON association_category.category_id = category.id
+                WHERE association_category.inventory_id = inventory.id
+            ), '')), 'B') ||
+            setweight(to_tsvector('english', coalesce(inventory.description, '')), 'C')
+        FROM inventory WHERE inventory.id = target
+        ON CONFLICT (inventory_id) DO UPDATE SET document = excluded.document
+    $$ LANGUAGE sql
+    """,
+    """
+    CREATE OR REPLACE FUNCTION inventory_search_inventory() RETURNS TRIGGER AS $$
+    BEGIN
+        PERFORM inventory_search_refresh(NEW.id);
+        RETURN NULL;
+    END
+    $$ LANGUAGE plpgsql
+    """,
+    """
+    CREATE OR REPLACE FUNCTION inventory_search_association() RETURNS TRIGGER AS $$
+    BEGIN
+        IF TG_OP = 'DELETE' THEN
+            PERFORM inventory_search_refresh(OLD.inventory_id);
+        ELSE
+            PERFORM inventory_search_refresh(NEW.inventory_id);
+        END IF;
+        RETURN NULL;
+    END
+    $$ LANGUAGE plpgsql
+    """,
+    """
+    CREATE OR REPLACE FUNCTION inventory_search_category() RETURNS TRIGGER AS $$
+    BEGIN
+        PERFORM inventory_search_refresh(inventory_id)
+        FROM association_category WHERE category_id = NEW.id;
+        RETURN NULL;
+    END
+    $$ LANGUAGE plpgsql
+    """,
+    "DROP TRIGGER IF EXISTS inventory_search_inventory ON inventory",
+    """
+    CREATE TRIGGER inventory_search_inventory AFTER INSERT OR UPDATE OF name, description ON inventory
+    FOR EACH ROW EXECUTE PROCEDURE inventory_search_inventory()
+    """,
+    "DROP TRIGGER IF EXISTS inventory_search_association ON association_category",
+    """
+    CREATE TRIGGER inventory_search_association AFTER INSERT OR DELETE ON association_category
+    FOR EACH ROW EXECUTE PROCEDURE inventory_search_association()
+    """,
+    "DROP TRIGGER IF EXISTS inventory_search_category ON category",
+    """
+    CREATE TRIGGER inventory_search_category AFTER UPDATE OF name ON category
+    FOR EACH ROW EXECUTE PROCEDURE inventory_search_category()
+    """,
+]
+
+POSTGRES_BACKFILL = [
+    "SELECT inventory_search_refresh(id) FROM inventory",
+]
+
+POSTGRES_SEARCH = """
+    SELECT inventory_id FROM inventory_search, to_tsquery('english', :query) AS query
+    WHERE document @@ query
+    ORDER BY ts_rank_cd(document, query) DESC, inventory_id
+    LIMIT :limit
+"""
+
+
+def create_search_index(connection):
+    """
+    Create the search index and its triggers for the database of
+    connection and index every existing inventory
+    """
+    if connection.dialect.name == "sqlite":
+        statements = SQLITE_SCHEMA + SQLITE_BACKFILL
+    elif connection.dialect.name == "postgresql":
+        statements = POSTGRES_SCHEMA + POSTGRES_BACKFILL
+    else:
+        raise RuntimeError(f"Full-text search is not supported on {connection.dialect.name}")
+    for statement in statements:
+        connection.exec_driver_sql(statement)
+
+
+def search_terms(q):
+    """
+    The words of a search string, anything but letters and digits is
+    dropped so that user input can't use the query syntax
+    """
+    return re.findall(r"\w+", q.lower())
+
+
+def match_query(dialect, terms):
+    """
+    Query matching every term, the last one as a prefix so that
+    results show up while the last word is being typed
+    """
+    if dialect == "postgresql":
+        return " & ".join(terms[:-1] + [terms[-1] + ":*"])
+    return " ".join([f'"{t}"' for t in terms[:-1]] + [f'"{terms[-1]}"*'])
+
+
+def search_inventory_ids(session, q, limit):
+    """
+    Ids of the inventories best matching the search string q, best first
+    """
+    terms = search_terms(q)
+    if not terms:
+        return []
+    dialect = session.get_bind().dialect.name
+    sql = POSTGRES_SEARCH if dialect == "postgresql" else SQLITE_SEARCH
+    return session.execute(
+        text(sql), {"query": match_query(dialect, terms), "limit": limit}
+    ).scalars().all()
@@ -0,0 +1,322 @@
+import os
+import shutil
+import tempfile
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from io import BytesIO
+
+import boto3
+try:
+    from gevent import monkey
+    from gevent.threadpool import ThreadPoolExecutor as NativeThreadPoolExecutor
+except ImportError:
+    monkey = None
+from botocore.config import Config
+from sqlalchemy import insert, update
+
+from changes import record_image_change
+from db import db
+from db import Asset
+from db import AssetVariant
+from images import FORMATS, parse_variants, render_variants
+
+
+class ImageTooLarge(Exception):
+    """
+    Raised while streaming an upload past its size limit
+    """
+
+
+class LimitedReader:
+    """
+    File-like object over an upload stream whose first bytes were already
+    consumed into header. It serves header and then the rest of stream,
+    and raises ImageTooLarge once more than limit bytes have been read.
+    Reads only come back short at the end of the stream, which s3transfer
+    relies on to detect the end of non-seekable streams
+    """
+
+    def __init__(self, header, stream, limit):
+        self.header = header
+        self.stream = stream
+        self.limit = limit
+        self.size = 0
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            return b"".join(iter(lambda: self.read(64 * 1024), b""))
+
+        parts = []
+        remaining = size
+        while remaining > 0:
+            if self.header:
+                chunk = self.header[:remaining]
+                self.header = self.header[len(chunk):]
+            else:
+                chunk = self.stream.read(remaining)
+                if not chunk:
+                    break
+            parts.append(chunk)
+            remaining -= len(chunk)
+
+        data = b"".join(parts)
+        self.size += len(data)
+        if self.size > self.limit:
+            raise ImageTooLarge(f"Image is larger than {self.limit} bytes")
+        return data
+
+
+class S3Storage:
+    """
+    Stores images in an S3 bucket through one shared client.
+    boto3 clients are thread safe and pool their connections, so every
+    upload worker reuses the same client instead of building a new one.
+    endpoint_url points the client at an S3 stand-in (moto server, MinIO)
+    """
+
+    def __init__(self, bucket, region="us-east-1", endpoint_url=None, max_pool_connections=10):
+        self.bucket = bucket
+        self.client = boto3.session.Session().client(
+            "s3",
+            region_name=region,
+            endpoint_url=endpoint_url,
+            config=Config(max_pool_connections=max_pool_connections)
+        )
+        if endpoint_url:
+            self.base_url = f"{endpoint_url.rstrip('/')}/{bucket}"
+        else:
+            self.base_url = f"https://{bucket}.s3.{region}.amazonaws.com"
+
+    def put(self, key, fileobj, content_type):
+        """
+        Stream fileobj to the bucket and make it public in the same request
+        """
+        self.client.upload_fileobj(
+            fileobj, self.bucket, key,
+            ExtraArgs={"ACL": "public-read", "ContentType": content_type}
+        )
+
+    def get(self, key):
+        return self.client.get_object(Bucket=self.bucket, Key=key)["Body"].read()
+
+
+class LocalStorage:
+    """
+    Stores images in a directory, for local development and tests.
+    Files are served by the /uploads/ route of the app
+    """
+
+    def __init__(self, root, base_url="/uploads"):
+        self.root = root
+        self.base_url = base_url
+        os.makedirs(root, exist_ok=True)
+
+    def put(self, key, fileobj, content_type):
+        """
+        Copy fileobj into the directory, the file only appears once complete
+        """
+        fd, tmp_path = tempfile.mkstemp(dir=self.root)
+        try:
+            with os.fdopen(fd, "wb") as f:
+                shutil.copyfileobj(fileobj, f)
+            os.replace(tmp_path, os.path.join(self.root, key))
+        except BaseException:
+            os.remove(tmp_path)
+            raise
+
+    def get(self, key):
+        with open(os.path.join(self.root, key), "rb") as f:
+            return f.read()
+
+
+def gevent_patched():
+    """
+    Whether gevent patched threading (wsgi.py, the production server),
+    threads then being greenlets that run on the worker's event loop
+    """
+    return monkey is not None and monkey.is_module_patched("threading")
+
+
+def create_storage(config):
+    """
+    Build the storage backend selected by STORAGE_BACKEND ("s3" or "local")
+    """
+    backend = config.get("STORAGE_BACKEND", "s3")
+    if backend == "s3":
+        return S3Storage(
+            config.get("S3_BUCKET_NAME"),
+            region=config.get("S3_REGION", "us-east-1"),
+            endpoint_url=config.get("S3_ENDPOINT_URL"),
+            max_pool_connections=config.get("S3_MAX_POOL_CONNECTIONS", 10)
+        )
+    if backend == "local":
+        return LocalStorage(config.get("LOCAL_STORAGE_DIR"), config.get("LOCAL_STORAGE_URL", "/uploads"))
+    raise RuntimeError(f"Unknown STORAGE_BACKEND: {backend}")
+
+
+class UploadQueue:
+    """
+    Uploads asset images on background worker threads so that requests
+    return as soon as the Asset row is committed. The Asset stays
+    "pending" until its upload finishes and is then marked "ready"
+    (or "failed"). With UPLOAD_WORKERS = 0 uploads run inline.
+
+    Each upload also renders the ASSET_VARIANTS sizes in every
+    ASSET_VARIANT_FORMATS format in a process pool of
+    DERIVATIVE_PROCESSES processes, uploads them next to the original
+    and records them as AssetVariant rows.
+
+    Under gevent the workers are real threads from gevent's native pool,
+    as greenlets would render images and wait on the database on the
+    event loop of the whole worker, and the variants are rendered on
+    them instead of in the process pool (PIL releases the GIL while it
+    resizes and encodes)
+    """
+
+    def __init__(self, app=None, on_complete=None):
+        self.app = None
+        self.storage = None
+        self.executor = None
+        self.processes = None
+        self.variants = []
+        self.formats = []
+        self.on_complete = on_complete
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.app = app
+        self.storage = create_storage(app.config)
+        workers = int(app.config.get("UPLOAD_WORKERS", 4))
+        if workers > 0 and gevent_patched():
+            self.executor = NativeThreadPoolExecutor(max_workers=workers)
+        elif workers > 0:
+            self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="upload")
+
+        self.variants = parse_variants(app.config.get("ASSET_VARIANTS", ""))
+        self.formats = [f for f in app.config.get("ASSET_VARIANT_FORMATS", "webp,jpeg").split(",") if f]
+        for fmt in self.formats:
+            if fmt not in FORMATS:
+                raise RuntimeError(f"Unknown image variant format: {fmt}")
+        processes = int(app.config.get("DERIVATIVE_PROCESSES", 0))
+        # the pool's feeder threads would be greenlets of another thread's loop
+        if self.variants and processes > 0 and not gevent_patched():
+            self.processes = ProcessPoolExecutor(max_workers=processes)
+
+    @property
+    def base_url(self):
+        return self.storage.base_url
+
+    def enqueue(self, asset_id, key, data, content_type):
+        """
+        Upload the image bytes data of a committed Asset under key
+        """
+        if self.executor is None:
+            self.upload(asset_id, key, data, content_type)
+        else:
+            self.submit(self.upload, asset_id, key, data, content_type)
+
+    def enqueue_variants(self, asset_id, key):
+        """
+        Create the variants of an image that was streamed into storage
+        under key, reading it back from storage
+        """
+        if self.executor is None:
+            self.derive(asset_id, key)
+        else:
+            self.submit(self.derive, asset_id, key)
+
+    def submit(self, fn, *args):
+        # nothing waits on the futures, their errors would be dropped
+        self.executor.submit(fn, *args).add_done_callback(self.log_failure)
+
+    def log_failure(self, future):
+        error = future.exception()
+        if error is not None:
+            self.app.logger.error("Error in a background upload", exc_info=error)
+
+    def upload(self, asset_id, key, data, content_type):
+        try:
+            self.storage.put(key, BytesIO(data), content_type)
+            status = "ready"
+        except Exception:
+            self.app.logger.exception(f"Error when uploading image {key}")
+            status = "failed"
+
+        variants = []
+        if status == "ready":
+            variants = self.create_variants(asset_id, key, data)
+        self.finish(asset_id, status, variants)
+
+    def derive(self, asset_id, key):
+        try:
+            data = self.storage.get(key)
+        except Exception:
+            self.app.logger.exception(f"Error when reading image {key}")
+            return
+        self.finish(asset_id, "ready", self.create_variants(asset_id, key, data))
+
+    def create_variants(self, asset_id, key, data):
+        if not self.variants:
+            return []
+        try:
+            return self.upload_variants(asset_id, key.rsplit(".", 1)[0], data)
+        except Exception:
+            self.app.logger.exception(f"Error when creating the variants of image {key}")
+            return []
+
+    def finish(self, asset_id, status, variants):
+        with self.app.app_context():
+            try:
+                db.session.execute(update(Asset).where(Asset.id == asset_id).values(status = status))
+                if variants:
+                    db.session.execute(insert(AssetVariant), variants)
+                # menus show the status and variants of their image
+                record_image_change(db.session, asset_id)
+                db.session.commit()
+            except Exception:
+                db.session.rollback()
+                self.app.logger.exception(f"Error when recording the upload of asset {asset_id}")
+                self.mark_failed(asset_id)
+
+        if self.on_complete is not None:
+            self.on_complete()
+
+    def mark_failed(self, asset_id):
+        """
+        Mark an Asset whose upload could not be recorded as failed rather
+        than leave it pending forever. Assets already ready keep their
+        status, their original image is in storage
+        """
+        try:
+            db.session.execute(
+                update(Asset).where(Asset.id == asset_id, Asset.status == "pending").values(status = "failed")
+            )
+            db.session.commit()
+        except Exception:
+            db.session.rollback()
+            self.app.logger.exception(f"Error when marking asset {asset_id} as failed")
+
+    def upload_variants(self, asset_id, salt, data):
+        """
+        Render and upload the configured variants of an image,
+        returns the AssetVariant rows to insert
+        """
+        if self.processes is None:
+            rendered = render_variants(data, self.variants, self.formats)
+        else:
+            rendered = self.processes.submit(render_variants, data, self.variants, self.formats).result()
+
+        variants = []
+        for key, fmt, width, height, variant_data in rendered:
+            extension, content_type = FORMATS[fmt]
+            variant = {
+                "asset_id": asset_id,
+                "key": key,
+                "salt": salt,
+                "extension": extension,
+                "width": width,
+                "height": height
+            }
+            self.storage.put(f"{salt}_{key}.{extension}", BytesIO(variant_data), content_type)
+            variants.append(variant)
+        return variants
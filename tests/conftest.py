@@ -0,0 +1,98 @@
+"""
+Every test module runs against one app on a throwaway SQLite database,
+configured before the app is imported
+"""
+import datetime
+import json
+import os
+import sys
+import tempfile
+
+import pytest
+from sqlalchemy import delete, event, insert
+from sqlalchemy.engine import Engine
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+TMP = tempfile.mkdtemp()
+os.environ.update(
+    DATABASE_URL=f"sqlite:///{os.path.join(TMP, 'test.db')}",
+    DATABASE_REPLICA_URLS="",
+    CACHE_BACKEND="none",
+    STORAGE_BACKEND="local",
+    LOCAL_STORAGE_DIR=os.path.join(TMP, "uploads"),
+    UPLOAD_WORKERS="0",
+    ASSET_VARIANTS="",
+    SQLALCHEMY_ECHO="0"
+)
+os.environ.pop("PROFILE_TOKEN", None)
+
+from app import app
+from db import db, inventory_category_association_table
+from db import CatalogChange, Category, Inventory, Order, Orderitem
+
+
+def seed_catalog(inventories, orders_per_inventory=3):
+    """
+    Replace every row with inventories, each in a category and in
+    orders_per_inventory orders
+    """
+    now = datetime.datetime.now()
+    with app.app_context():
+        for table in reversed(db.metadata.sorted_tables):
+            db.session.execute(delete(table))
+        db.session.execute(insert(Category), [{"id": 1, "name": "Fruit", "description": ""}])
+        if inventories:
+            db.session.execute(insert(Inventory), [
+                {"id": i, "image": "", "name": f"item {i}", "description": "", "price": 1.0}
+                for i in range(1, inventories + 1)
+            ])
+            db.session.execute(insert(inventory_category_association_table), [
+                {"inventory_id": i, "category_id": 1} for i in range(1, inventories + 1)
+            ])
+            db.session.execute(insert(CatalogChange), [
+                {"entity": "inventory", "entity_id": i, "op": "upsert", "changed_at": now}
+                for i in range(1, inventories + 1)
+            ])
+        if inventories and orders_per_inventory:
+            db.session.execute(insert(Order), [
+                {"id": o, "time_created": now, "pick_up_by": now, "total_price": 1.0, "valid": True}
+                for o in range(1, orders_per_inventory + 1)
+            ])
+            db.session.execute(insert(Orderitem), [
+                {"order_id": o, "inventory_id": i, "num_sel": o}
+                for i in range(1, inventories + 1) for o in range(1, orders_per_inventory + 1)
+            ])
+        db.session.commit()
+
+
+@pytest.fixture
+def seed():
+    return seed_catalog
+
+
+@pytest.fixture
+def client():
+    return app.test_client()
+
+
+@pytest.fixture
+def count_queries(client):
+    """
+    GET url, returns the number of SQL statements it ran and its JSON
+    """
+    def count_queries(url):
+        count = [0]
+
+        def before_cursor_execute(*args):
+            count[0] += 1
+
+        event.listen(Engine, "before_cursor_execute", before_cursor_execute)
+        try:
+            response = client.get(url)
+        finally:
+            event.remove(Engine, "before_cursor_execute", before_cursor_execute)
+        assert response.status_code == 200
+        return count[0], json.loads(response.data)
+    return count_queries
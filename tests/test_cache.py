@@ -0,0 +1,89 @@
+"""
+The read-through response cache: hits skip the database and every write
+makes the responses that depend on it unreachable
+"""
+import pytest
+from flask import Flask
+
+from app import response_cache
+from cache import MemoryBackend, ResponseCache
+
+
+@pytest.fixture
+def cache(monkeypatch):
+    monkeypatch.setattr(response_cache, "backend", MemoryBackend())
+    return response_cache
+
+
+def test_a_repeated_read_is_served_without_sql(seed, count_queries, cache):
+    seed(10)
+    queries, first = count_queries("/inventories/")
+    assert queries > 0
+    queries, second = count_queries("/inventories/")
+    assert queries == 0
+    assert first == second
+    assert cache.stats()["hits"] >= 1
+
+
+def test_catalog_writes_invalidate_catalog_reads(seed, client, count_queries, cache):
+    seed(1)
+    count_queries("/inventories/")
+    response = client.post("/inventories/", json={"image": "", "name": "pear", "description": "", "price": 2.0})
+    assert response.status_code == 201
+    queries, data = count_queries("/inventories/")
+    assert queries > 0
+    assert [i["name"] for i in data["inventories"]] == ["item 1", "pear"]
+
+
+def test_order_writes_invalidate_the_selected_numbers(seed, client, count_queries, cache):
+    seed(1, orders_per_inventory=0)
+    _, data = count_queries("/inventories/")
+    assert data["inventories"][0]["selectedNum"] == 0
+    response = client.post("/orders/", json={"inventories": [{"inventory_id": 1, "num_sel": 4}]})
+    assert response.status_code == 201
+    _, data = count_queries("/inventories/")
+    assert data["inventories"][0]["selectedNum"] == 4
+
+
+def test_failed_writes_keep_the_cache(seed, client, count_queries, cache):
+    seed(1)
+    count_queries("/inventories/")
+    response = client.post("/orderitems/1/999/increase/")
+    assert response.status_code == 404
+    queries, _ = count_queries("/inventories/")
+    assert queries == 0
+
+
+def test_memory_backend_can_be_refused():
+    app = Flask(__name__)
+    app.config.update(CACHE_BACKEND="memory", CACHE_ALLOW_MEMORY=False)
+    with pytest.raises(RuntimeError):
+        ResponseCache(app)
+
+
+@pytest.mark.parametrize("url", ["/inventories/", "/orders/1/"])
+def test_a_matching_etag_is_answered_with_304(seed, client, url):
+    seed(3)
+    response = client.get(url)
+    etag = response.headers["ETag"]
+    response = client.get(url, headers={"If-None-Match": etag})
+    assert response.status_code == 304
+    assert response.data == b""
+
+
+def test_a_cache_hit_keeps_its_etag(seed, client, cache):
+    seed(3)
+    first = client.get("/inventories/")
+    hits = cache.stats()["hits"]
+    second = client.get("/inventories/", headers={"If-None-Match": first.headers["ETag"]})
+    assert second.status_code == 304
+    assert cache.stats()["hits"] == hits + 1
+
+
+def test_a_write_changes_the_etag(seed, client, cache):
+    seed(3)
+    before = client.get("/orders/1/").headers["ETag"]
+    assert client.post("/orderitems/1/1/increase/").status_code < 400
+    response = client.get("/orders/1/", headers={"If-None-Match": before})
+    assert response.status_code == 200
+    assert response.headers["ETag"] != before
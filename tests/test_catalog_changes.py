@@ -0,0 +1,53 @@
+"""
+Incremental catalog sync through GET /catalog/changes/
+"""
+import json
+
+from app import app
+from db import db
+from db import Asset, Menu
+
+
+def changes(client, since, limit=100):
+    response = client.get(f"/catalog/changes/?since={since}&limit={limit}")
+    assert response.status_code == 200
+    return json.loads(response.data)
+
+
+def test_since_past_64_bits_is_rejected(client):
+    assert client.get("/catalog/changes/?since=99999999999999999999").status_code == 400
+
+
+def test_changes_are_paged_with_next(seed, client):
+    seed(3)
+    page = changes(client, 0, limit=2)
+    assert [i["id"] for i in page["inventories"]["upserts"]] == [1, 2]
+    assert page["has_more"]
+    page = changes(client, page["next"], limit=2)
+    assert [i["id"] for i in page["inventories"]["upserts"]] == [3]
+    assert not page["has_more"]
+    last = changes(client, page["next"])
+    assert last["inventories"] == {"upserts": [], "deletes": []}
+    assert last["next"] == page["next"]
+
+
+def test_a_deleted_menu_is_synced_as_a_delete(seed, client):
+    seed(1)
+    since = changes(client, 0)["next"]
+    with app.app_context():
+        asset = Asset(base_url="", extension="png", width=4, height=4)
+        db.session.add(asset)
+        db.session.flush()
+        menu = Menu(name="salad", description="", instruction="", image_id=asset.id)
+        db.session.add(menu)
+        db.session.commit()
+        menu_id = menu.id
+
+    page = changes(client, since)
+    assert [m["id"] for m in page["menus"]["upserts"]] == [menu_id]
+    assert client.delete(f"/menus/{menu_id}/").status_code == 200
+    # the upsert and the delete of one sync are folded into the delete
+    page = changes(client, since)
+    assert page["menus"] == {"upserts": [], "deletes": [menu_id]}
+    page = changes(client, page["next"] - 1)
+    assert page["menus"] == {"upserts": [], "deletes": [menu_id]}
@@ -0,0 +1,47 @@
+"""
+The event bus behind GET /events/
+"""
+import pytest
+from flask import Flask
+
+from app import events
+from events import EventBus
+
+
+def test_memory_backend_can_be_refused():
+    app = Flask(__name__)
+    app.config.update(EVENTS_BACKEND="memory", EVENTS_ALLOW_MEMORY=False)
+    with pytest.raises(RuntimeError):
+        EventBus(app)
+
+
+def test_no_backend_publishes_nothing_and_refuses_streams(client, monkeypatch):
+    monkeypatch.setattr(events, "enabled", False)
+    events.publish(["orders"], "order_updated", {"order_id": 1})
+    assert client.get("/events/?channel=orders").status_code == 503
+
+
+def frames(subscription):
+    received = []
+    while True:
+        frame = subscription.get(timeout=0)
+        if frame is None:
+            return received
+        received.append(frame)
+
+
+def test_an_event_reaches_each_subscriber_once(seed, client):
+    seed(1, orders_per_inventory=2)
+    both = events.subscribe(["order:1", "orders"])
+    one = events.subscribe(["order:1"])
+    other = events.subscribe(["order:2"])
+    catalog = events.subscribe(["catalog"])
+    try:
+        assert client.post("/orderitems/1/1/increase/").status_code == 200
+        assert [frame.split("\n")[0] for frame in frames(both)] == ["event: order_updated"]
+        assert [frame.split("\n")[0] for frame in frames(one)] == ["event: order_updated"]
+        assert frames(other) == []
+        assert frames(catalog) == []
+    finally:
+        for subscription in [both, one, other, catalog]:
+            events.unsubscribe(subscription)
@@ -0,0 +1,39 @@
+"""
+What the inventory and category reads show, and the arguments they refuse
+"""
+import pytest
+from sqlalchemy import delete, insert
+
+from app import app
+from db import db, inventory_category_association_table
+from db import Category
+
+
+def test_serialize_for_render_shows_the_first_orderitem_and_category(seed, count_queries):
+    seed(10)
+    _, data = count_queries("/inventories/")
+    assert data["inventories"][0]["selectedNum"] == 1
+    assert data["inventories"][0]["category"] == 1
+
+
+def test_serialize_for_render_shows_the_category_assigned_first(seed, count_queries):
+    seed(1)
+    with app.app_context():
+        db.session.execute(insert(Category), [{"id": 2, "name": "Sale", "description": ""}])
+        db.session.execute(delete(inventory_category_association_table))
+        db.session.execute(insert(inventory_category_association_table), [
+            {"inventory_id": 1, "category_id": 2}, {"inventory_id": 1, "category_id": 1}
+        ])
+        db.session.commit()
+    _, data = count_queries("/inventories/")
+    assert data["inventories"][0]["category"] == 2
+
+
+@pytest.mark.parametrize("url", [
+    "/inventories/?category=99999999999999999999",
+    "/inventories/?menu=-99999999999999999999",
+    "/categories/m/?ids=1,99999999999999999999",
+    "/categories/m/?c0=99999999999999999999",
+])
+def test_ids_past_64_bits_are_rejected(client, url):
+    assert client.get(url).status_code == 400
@@ -0,0 +1,62 @@
+"""
+/metrics sums the snapshots of every worker sharing METRICS_DIR
+"""
+import json
+import subprocess
+import sys
+
+from app import metrics
+
+
+def exited_pid():
+    process = subprocess.Popen([sys.executable, "-c", "pass"])
+    process.wait()
+    return process.pid
+
+
+def worker_snapshot(pid):
+    return {
+        "pid": pid,
+        "latency": [["get_order_by_id", "GET", [1] * 11, 1, 0.004]],
+        "queries": [["get_order_by_id", "GET", [0, 1, 1, 1, 1, 1, 1, 1], 1, 2]],
+        "sql_time": [["get_order_by_id", "GET", 0.5]],
+        "serialize_time": [["get_order_by_id", "GET", 0.25]],
+        "responses": [["get_order_by_id", "GET", 200, 1]],
+        "over_budget": [],
+        "gauges": {"event_subscribers": {"subscribers": 7, "delivered": 0, "dropped": 0}}
+    }
+
+
+def metric(text, line_start):
+    values = [line.rsplit(" ", 1)[1] for line in text.splitlines() if line.startswith(line_start)]
+    assert len(values) == 1, values
+    return values[0]
+
+
+def test_metrics_of_every_worker_are_summed(seed, client, monkeypatch, tmp_path):
+    seed(1)
+    client.get("/orders/1/")
+    own = metrics.snapshot()
+    own_count = next(count for *key, _, count, _ in own["latency"] if key == ["get_order_by_id", "GET"])
+    # set after the request, which would start the writer thread
+    monkeypatch.setattr(metrics, "directory", str(tmp_path))
+    monkeypatch.setattr(metrics, "snapshot_path", str(tmp_path / "self.json"))
+
+    running = worker_snapshot(own["pid"])
+    exited = worker_snapshot(exited_pid())
+    for name, snapshot in [("running.json", running), ("exited.json", exited)]:
+        (tmp_path / name).write_text(json.dumps(snapshot))
+    (tmp_path / "partial.json.tmp").write_text("{")
+
+    text = metrics.render()
+    assert metric(text, 'http_request_duration_seconds_count{endpoint="get_order_by_id",method="GET"}') == str(own_count + 2)
+    # the gauges of an exited worker are gone, its counters are kept
+    assert metric(text, 'event_subscribers{kind="subscribers"}') == "7"
+    assert float(metric(text, 'db_query_duration_seconds_total{endpoint="get_order_by_id",method="GET"}')) >= 1.0
+
+
+def test_snapshots_are_written_whole(monkeypatch, tmp_path):
+    monkeypatch.setattr(metrics, "snapshot_path", str(tmp_path / "worker.json"))
+    metrics.write_snapshot()
+    assert [p.name for p in tmp_path.iterdir()] == ["worker.json"]
+    assert json.loads((tmp_path / "worker.json").read_text())["pid"] == metrics.snapshot()["pid"]
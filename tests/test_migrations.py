@@ -0,0 +1,108 @@
+"""
+A database created by the first version of the app is upgraded in place
+"""
+import datetime
+
+from sqlalchemy import create_engine, inspect, select
+from sqlalchemy.orm import Session, selectinload
+
+from db import db
+from db import Category, Inventory, Order
+from migrations import MIGRATIONS, upgrade
+
+# the schema db.create_all() created before the first migration
+BASELINE_SCHEMA = [
+    """
+    CREATE TABLE inventory (
+        id INTEGER NOT NULL, image VARCHAR NOT NULL, name VARCHAR NOT NULL,
+        description VARCHAR NOT NULL, price FLOAT NOT NULL, PRIMARY KEY (id)
+    )
+    """,
+    """
+    CREATE TABLE category (
+        id INTEGER NOT NULL, name VARCHAR NOT NULL, description VARCHAR NOT NULL, PRIMARY KEY (id)
+    )
+    """,
+    """
+    CREATE TABLE "order" (
+        id INTEGER NOT NULL, time_created DATETIME, pick_up_by DATETIME,
+        total_price FLOAT NOT NULL, valid BOOLEAN NOT NULL, PRIMARY KEY (id)
+    )
+    """,
+    """
+    CREATE TABLE assets (
+        id INTEGER NOT NULL, base_url VARCHAR, salt VARCHAR NOT NULL, extension VARCHAR NOT NULL,
+        width INTEGER NOT NULL, height INTEGER NOT NULL, created_at DATETIME NOT NULL, PRIMARY KEY (id)
+    )
+    """,
+    """
+    CREATE TABLE association_category (
+        inventory_id INTEGER REFERENCES inventory (id), category_id INTEGER REFERENCES category (id)
+    )
+    """,
+    """
+    CREATE TABLE menu (
+        id INTEGER NOT NULL, name VARCHAR NOT NULL, description VARCHAR NOT NULL,
+        instruction VARCHAR NOT NULL, image_id INTEGER NOT NULL REFERENCES assets (id), PRIMARY KEY (id)
+    )
+    """,
+    """
+    CREATE TABLE orderitem (
+        id INTEGER NOT NULL, num_sel INTEGER NOT NULL,
+        inventory_id INTEGER NOT NULL REFERENCES inventory (id),
+        order_id INTEGER NOT NULL REFERENCES "order" (id), PRIMARY KEY (id)
+    )
+    """,
+    """
+    CREATE TABLE association_menu (
+        inventory_id INTEGER REFERENCES inventory (id), menu_id INTEGER REFERENCES menu (id)
+    )
+    """,
+]
+
+BASELINE_ROWS = [
+    "INSERT INTO inventory VALUES (1, '', 'apple', 'red', 1.0), (2, '', 'pear', 'green', 2.0)",
+    "INSERT INTO category VALUES (1, 'Fruit', ''), (2, 'Sale', '')",
+    # assigned Sale first, after Fruit in id order
+    "INSERT INTO association_category VALUES (1, 2), (1, 1)",
+    "INSERT INTO \"order\" VALUES (1, '2024-01-01 10:00:00', '2024-01-01 12:00:00', 5.0, 1)",
+    # pear was added to the cart first, twice before lines were merged
+    "INSERT INTO orderitem VALUES (1, 1, 2, 1), (2, 1, 1, 1), (3, 1, 2, 1)",
+]
+
+
+def baseline_database(path):
+    engine = create_engine(f"sqlite:///{path}")
+    with engine.begin() as connection:
+        for statement in BASELINE_SCHEMA + BASELINE_ROWS:
+            connection.exec_driver_sql(statement)
+    return engine
+
+
+def test_a_baseline_database_is_upgraded_in_place(tmp_path):
+    engine = baseline_database(tmp_path / "baseline.db")
+    # what the app does at startup
+    db.metadata.create_all(engine)
+    assert upgrade(engine) == [version for version, _, _ in MIGRATIONS]
+    assert upgrade(engine) == []
+
+    indexes = {index["name"] for index in inspect(engine).get_indexes("orderitem")}
+    assert {"uq_orderitem_order_inventory", "ix_orderitem_order_id_id"} <= indexes
+    assert "status" in [column["name"] for column in inspect(engine).get_columns("assets")]
+
+    with Session(engine) as session:
+        apple = session.get(Inventory, 1)
+        assert [c.name for c in apple.categories] == ["Sale", "Fruit"]
+        assert session.get(Category, 2).inventories == [apple]
+
+        order = session.execute(
+            select(Order).options(selectinload(Order.order_items))
+        ).scalar_one()
+        # duplicate lines are merged into the first one, cart order is kept
+        assert [(i.id, i.inventory_id, i.num_sel) for i in order.order_items] == [(1, 2, 2), (2, 1, 1)]
+
+        with engine.connect() as connection:
+            rowids = connection.exec_driver_sql(
+                "SELECT rowid FROM inventory_search WHERE inventory_search MATCH 'sale'"
+            ).scalars().all()
+        assert rowids == [1]
@@ -0,0 +1,100 @@
+"""
+Creating orders and changing their carts
+"""
+import json
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+from app import app
+from db import db
+from db import Order, Orderitem
+
+
+@pytest.mark.parametrize("line", [
+    {"inventory_id": 2 ** 64, "num_sel": 1},
+    {"inventory_id": 1, "num_sel": 2 ** 64},
+])
+def test_out_of_range_cart_lines_are_rejected(seed, client, line):
+    seed(10)
+    response = client.post("/orders/", json={"inventories": [line]})
+    assert response.status_code == 400
+    response = client.put("/orders/1/items", json={"inventories": [line]})
+    assert response.status_code == 400
+
+
+def order_json(client, order_id):
+    response = client.get(f"/orders/{order_id}/")
+    return json.loads(response.data) if response.status_code == 200 else None
+
+
+def test_increase_and_decrease_change_the_line_and_the_total(seed, client):
+    seed(2)
+    response = client.post("/orderitems/2/1/increase/")
+    assert response.status_code == 200
+    data = json.loads(response.data)
+    assert (data["num_sel"], data["total_price"], data["deleted"]) == (3, 2.0, False)
+    data = json.loads(client.post("/orderitems/2/1/decrease/").data)
+    assert (data["num_sel"], data["total_price"]) == (2, 1.0)
+    assert client.post("/orderitems/2/999/increase/").status_code == 404
+
+
+def test_decreasing_to_zero_deletes_the_line_and_then_the_order(seed, client):
+    seed(2, orders_per_inventory=1)
+    data = json.loads(client.post("/orderitems/1/1/decrease/").data)
+    assert (data["num_sel"], data["deleted"], data["order_deleted"]) == (0, True, False)
+    assert [i["name"] for i in order_json(client, 1)["order_items"]] == ["item 2"]
+    assert client.post("/orderitems/1/1/decrease/").status_code == 404
+
+    data = json.loads(client.post("/orderitems/1/2/decrease/").data)
+    assert (data["deleted"], data["order_deleted"]) == (True, True)
+    assert order_json(client, 1) is None
+
+
+def test_concurrent_increases_all_land(seed):
+    seed(1, orders_per_inventory=1)
+
+    def increase(_):
+        return app.test_client().post("/orderitems/1/1/increase/").status_code
+
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        codes = list(executor.map(increase, range(80)))
+    assert codes == [200] * 80
+    with app.app_context():
+        orderitem = Orderitem.query.filter_by(order_id=1, inventory_id=1).one()
+        assert orderitem.num_sel == 81
+        assert db.session.get(Order, 1).total_price == 81.0
+
+
+def test_putting_a_cart_inserts_updates_and_deletes_lines(seed, client):
+    seed(3, orders_per_inventory=1)
+    client.post("/orderitems/1/3/decrease/")
+    response = client.put("/orders/1/items", json={"inventories": [
+        {"inventory_id": 1, "num_sel": 5},
+        {"inventory_id": 3, "num_sel": 2},
+    ]})
+    assert response.status_code == 200
+    data = json.loads(response.data)
+    assert data["total_price"] == 7.0
+    assert [(i["name"], i["selectedNum"]) for i in data["order_items"]] == [("item 1", 5), ("item 3", 2)]
+    assert order_json(client, 1) == data
+    assert client.put("/orders/999/items", json={"inventories": []}).status_code == 404
+
+
+def test_cart_lines_keep_the_order_they_were_added_in(seed, client):
+    seed(3, orders_per_inventory=0)
+    response = client.post("/orders/", json={"inventories": [
+        {"inventory_id": 3, "num_sel": 1},
+        {"inventory_id": 1, "num_sel": 1},
+    ]})
+    order_id = json.loads(response.data)["id"]
+    client.put(f"/orders/{order_id}/items", json={"inventories": [
+        {"inventory_id": 3, "num_sel": 1},
+        {"inventory_id": 1, "num_sel": 1},
+        {"inventory_id": 2, "num_sel": 1},
+    ]})
+    names = ["item 3", "item 1", "item 2"]
+    assert [i["name"] for i in order_json(client, order_id)["order_items"]] == names
+    for url in ["/orders/", "/orders/?limit=10"]:
+        orders = json.loads(client.get(url).data)["orders"]
+        assert [i["name"] for i in orders[0]["order_items"]] == names
@@ -0,0 +1,30 @@
+"""
+The list endpoints must run the same number of SQL statements whatever
+the number of rows they return
+"""
+import pytest
+
+
+@pytest.mark.parametrize("url", [
+    "/inventories/",
+    "/inventories/?limit=1000",
+    "/inventories/?category=1&sort=-price",
+    "/inventories/search/?q=item",
+    "/catalog/changes/?since=0",
+])
+def test_inventory_lists_run_a_fixed_number_of_queries(seed, count_queries, url):
+    seed(10)
+    small, _ = count_queries(url)
+    seed(1000)
+    large, _ = count_queries(url)
+    assert small == large, f"{small} statements for 10 inventories, {large} for 1000"
+
+
+def test_streamed_orders_run_a_fixed_number_of_queries(seed, count_queries):
+    seed(10, orders_per_inventory=3)
+    small, _ = count_queries("/orders/")
+    seed(10, orders_per_inventory=1200)
+    large, data = count_queries("/orders/")
+    assert small == large, f"{small} statements for 3 orders, {large} for 1200"
+    _, page = count_queries("/orders/?limit=1000")
+    assert data["orders"][:1000] == page["orders"]
@@ -0,0 +1,70 @@
+"""
+Image uploads through POST /assets/
+"""
+import json
+from concurrent.futures import ThreadPoolExecutor
+from io import BytesIO
+
+from PIL import Image
+
+import storage
+from app import app, uploads
+from db import db
+from db import Asset
+
+
+def png(width=4, height=4):
+    image = BytesIO()
+    Image.new("RGB", (width, height)).save(image, "PNG")
+    return image.getvalue()
+
+
+def test_uploads_are_stored_outside_of_a_transaction(client, monkeypatch):
+    in_transaction = []
+    put = uploads.storage.put
+
+    def checked_put(*args):
+        in_transaction.append(db.session().in_transaction())
+        put(*args)
+
+    monkeypatch.setattr(uploads.storage, "put", checked_put)
+    response = client.post("/assets/", data=png(), content_type="image/png")
+    assert response.status_code == 201
+    assert json.loads(response.data)["status"] == "ready"
+    assert in_transaction and not any(in_transaction)
+
+
+def pending_asset():
+    with app.app_context():
+        asset = Asset(base_url=uploads.base_url, extension="png", width=4, height=4)
+        db.session.add(asset)
+        db.session.commit()
+        return asset.id
+
+
+def asset_status(asset_id):
+    with app.app_context():
+        return db.session.get(Asset, asset_id).status
+
+
+def test_an_upload_that_cannot_be_recorded_is_marked_failed(monkeypatch, caplog):
+    def broken(*args):
+        raise RuntimeError("change log unavailable")
+
+    monkeypatch.setattr(storage, "record_image_change", broken)
+    asset_id = pending_asset()
+    uploads.enqueue(asset_id, "broken.png", png(), "image/png")
+    assert asset_status(asset_id) == "failed"
+    assert "Error when recording the upload of asset" in caplog.text
+
+
+def test_background_upload_errors_are_logged(monkeypatch, caplog):
+    def broken(*args):
+        raise RuntimeError("worker crashed")
+
+    executor = ThreadPoolExecutor(max_workers=1)
+    monkeypatch.setattr(uploads, "executor", executor)
+    monkeypatch.setattr(uploads, "upload", broken)
+    uploads.enqueue(pending_asset(), "crashed.png", png(), "image/png")
+    executor.shutdown(wait=True)
+    assert "worker crashed" in caplog.text
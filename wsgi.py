@@ -0,0 +1,8 @@
+# entry point of the production server: gevent has to patch the standard
+# library before the app creates its locks and queues, so that an idle
+# /events/ stream is a greenlet waiting on a queue instead of a thread
+from gevent import monkey
+
+monkey.patch_all()
+
+from app import app